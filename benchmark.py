@@ -0,0 +1,222 @@
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from initialState import loadInitialState
+from packedEngine import PackedShrubEngine
+from shrubEngine import MODEL_VERSION, ShrubEngine, defaultParameters
+from sparseEngine import SparseShrubEngine
+from sweepExecutor import runSweep
+from threadedEngine import ThreadedShrubEngine
+from tiledEngine import TiledShrubEngine
+
+# headless benchmarks of the model, written to a JSON file so runs on different commits or machines can be compared:
+#   step      cells updated per second by a single step of every engine, for maps from 200x200 to 4000x4000
+#   sweep     runs per second of a representative (h, n, f) sweep on 1, 2, 4, ... worker processes
+#   pcraster  the same step with the PCRaster operations of the original ShrubManage.dynamic(), if pcraster is
+#             installed
+# every measurement runs in a fresh process, so its peak resident memory (peakRss, in bytes) is its own
+#
+#   python benchmark.py --output benchmark.json [--quick]
+engines = {
+    'numpy': ShrubEngine,
+    'packed': PackedShrubEngine,
+    'threaded': ThreadedShrubEngine,
+    'sparse': SparseShrubEngine,
+    'tiled': TiledShrubEngine,
+}
+mapSizes = [200, 500, 1000, 2000, 4000]
+quickMapSizes = [200, 500]
+# parameters of the benchmarked steps and runs, a map with shrubs, grass and removal events every other step
+stepParameters = (0.5, 2, 0.3)
+# (rows, columns) of the sweep, with h = 0.5, n from 1 to 10 and f from 0 to 0.9, like customLoopModel.py. runSweep
+# runs a row per task, so the sweep gets sweepTasksPerWorker rows for every worker of the largest worker count
+# (at least sweepShape[0]), and all worker counts run the same sweep
+sweepShape = (10, 10)
+sweepTasksPerWorker = 4
+# timesteps of every run of the sweep, enough for the runs to outweigh starting the worker pool
+nrOfTimeSteps = 100
+
+
+def peakRss():
+    #peak resident memory of this process in bytes (ru_maxrss is in kilobytes on Linux, in bytes on macOS)
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+def benchmarkMap(size):
+    #size x size map tiled from initialStateA, so every size has the same mix of empty, grass and shrub patches
+    initialState = np.asarray(loadInitialState('initialStateA.map'))
+    reps = -(-size // np.array(initialState.shape))
+    return np.tile(initialState, reps)[:size, :size]
+
+
+def timeSteps(engine, steps):
+    #seconds per step after a first step that is not timed (buffers, pools and caches are set up there)
+    engine.step()
+    start = time.perf_counter()
+    for _ in range(steps):
+        engine.step()
+    return (time.perf_counter() - start) / steps
+
+
+def stepBenchmark(task):
+    name, size, steps = task
+    biotop = benchmarkMap(size)
+    engine = engines[name](biotop, *stepParameters, seed=0)
+    seconds = timeSteps(engine, steps)
+    if hasattr(engine, 'close'):
+        engine.close()
+    return {'engine': name, 'size': size, 'cells': size * size, 'steps': steps, 'secondsPerStep': seconds,
+            'cellsPerSecond': size * size / seconds, 'peakRss': peakRss()}
+
+
+def pcrasterBenchmark(task):
+    #the step of the original ShrubManage.dynamic() in PCRaster operations, for comparing the engines with it
+    size, steps = task
+    try:
+        import pcraster
+    except ImportError:
+        return {'engine': 'pcraster', 'size': size, 'available': False}
+    h, n, f = stepParameters
+    parameters = defaultParameters
+    pcraster.setclone(size, size, 1, 0, 0)
+    biotop = pcraster.numpy2pcr(pcraster.Nominal, benchmarkMap(size).astype(np.int32), 255)
+    year = 0
+
+    def step(biotop, year):
+        year = year + 1
+        shrub = biotop == 2
+        grass = biotop == 1
+        realization = pcraster.uniform(1) < f
+        random = pcraster.uniform(1)
+        qge = pcraster.window4total(pcraster.scalar(grass)) / 4
+        pg = pcraster.maptotal(pcraster.scalar(grass)) / (size * size)
+        weg = parameters['bg'] * qge + parameters['theta'] * pg
+        grassGrowth = pcraster.ifthenelse(weg > random, biotop == 0, grass)
+        grassGrowth = pcraster.ifthenelse(grassGrowth == True, grassGrowth ^ grass, False)
+        grassDeath = pcraster.ifthenelse(parameters['dg'] > random, grass, False)
+        biotop = pcraster.ifthenelse(grassGrowth, 1, biotop)
+        biotop = pcraster.ifthenelse(grassDeath, 0, biotop)
+        qs = pcraster.window4total(pcraster.scalar(shrub)) / 4
+        wes = ((1 - qs) * parameters['b1'] + parameters['s1']) * qs
+        wgs = ((1 - qs) * parameters['b2'] * (1 - h) + parameters['s2']) * qs
+        wse = parameters['ds'] + parameters['c'] * qs
+        shrubGrowth = pcraster.pcror(pcraster.ifthenelse(wes > random, biotop == 0, shrub),
+                                     pcraster.ifthenelse(wgs > random, biotop == 1, shrub))
+        shrubGrowth = pcraster.ifthenelse(shrubGrowth == True, shrubGrowth ^ shrub, False)
+        shrubDeath = pcraster.ifthenelse(wse > random, shrub, False)
+        biotop = pcraster.ifthenelse(shrubGrowth, 2, biotop)
+        biotop = pcraster.ifthenelse(shrubDeath, 0, biotop)
+        if year == n:
+            biotop = pcraster.ifthenelse(pcraster.pcrand(realization, shrub), 0, biotop)
+            year = 0
+        return biotop, year
+
+    biotop, year = step(biotop, year)
+    start = time.perf_counter()
+    for _ in range(steps):
+        biotop, year = step(biotop, year)
+    seconds = (time.perf_counter() - start) / steps
+    return {'engine': 'pcraster', 'size': size, 'available': True, 'cells': size * size, 'steps': steps,
+            'secondsPerStep': seconds, 'cellsPerSecond': size * size / seconds, 'peakRss': peakRss()}
+
+
+def sweepArray(rows):
+    columns = sweepShape[1]
+    parameterArray = np.empty((rows, columns, 3))
+    parameterArray[..., 0] = stepParameters[0]
+    parameterArray[..., 1] = (np.arange(rows) % 10 + 1).reshape(-1, 1)
+    parameterArray[..., 2] = np.arange(columns) / columns
+    return parameterArray
+
+
+def sweepRows(workers):
+    #rows of the sweep run for the worker counts workers
+    return max(sweepShape[0], sweepTasksPerWorker * max(workers))
+
+
+def sweepBenchmark(task):
+    workers, rows = task
+    parameterArray = sweepArray(rows)
+    initialState = loadInitialState('initialStateA.map')
+    start = time.perf_counter()
+    runSweep(parameterArray, initialState, nrOfTimeSteps, workers=workers)
+    seconds = time.perf_counter() - start
+    runs = parameterArray.shape[0] * parameterArray.shape[1]
+    #the workers are child processes of the measuring process, their peak is counted separately
+    children = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    return {'workers': workers, 'tasks': rows, 'runs': runs, 'timesteps': nrOfTimeSteps, 'seconds': seconds,
+            'runsPerSecond': runs / seconds, 'peakRss': peakRss(),
+            'peakWorkerRss': children if sys.platform == 'darwin' else children * 1024}
+
+
+def isolated(function, task):
+    #runs function(task) in a fresh process, so its peak memory is not that of earlier measurements
+    with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context('spawn')) as executor:
+        return executor.submit(function, task).result()
+
+
+def workerCounts():
+    counts = [1]
+    while counts[-1] * 2 <= (os.cpu_count() or 1):
+        counts.append(counts[-1] * 2)
+    if counts[-1] != (os.cpu_count() or 1):
+        counts.append(os.cpu_count())
+    return counts
+
+
+def runBenchmarks(sizes=None, steps=5, names=None, workers=None, report=print):
+    #all benchmarks as a dict that is written to JSON, report gets a line for every finished measurement
+    sizes = mapSizes if sizes is None else sizes
+    names = list(engines) if names is None else names
+    workers = workerCounts() if workers is None else workers
+    results = {
+        'machine': {'platform': platform.platform(), 'processor': platform.processor(), 'cpus': os.cpu_count(),
+                    'python': platform.python_version(), 'numpy': np.__version__},
+        'modelVersion': MODEL_VERSION,
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'step': [],
+        'pcraster': [],
+        'sweep': [],
+    }
+    for size in sizes:
+        for name in names:
+            result = isolated(stepBenchmark, (name, size, steps))
+            results['step'].append(result)
+            report("step %-9s %5d^2  %.3g cells/s  %.0f MB" % (name, size, result['cellsPerSecond'],
+                                                               result['peakRss'] / 2 ** 20))
+        result = isolated(pcrasterBenchmark, (size, steps))
+        results['pcraster'].append(result)
+        if result['available']:
+            report("step pcraster  %5d^2  %.3g cells/s" % (size, result['cellsPerSecond']))
+    rows = sweepRows(workers)
+    for count in workers:
+        result = isolated(sweepBenchmark, (count, rows))
+        results['sweep'].append(result)
+        report("sweep %2d workers  %.3g runs/s" % (count, result['runsPerSecond']))
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="benchmarks of the shrub model, written to a JSON file")
+    parser.add_argument('--output', default='benchmark.json', help="JSON file for the results")
+    parser.add_argument('--sizes', type=int, nargs='+', help="map sizes of the step benchmark (default %s)"
+                        % " ".join(str(size) for size in mapSizes))
+    parser.add_argument('--steps', type=int, default=5, help="timed steps per map size")
+    parser.add_argument('--engines', nargs='+', choices=list(engines), help="engines of the step benchmark")
+    parser.add_argument('--workers', type=int, nargs='+', help="worker counts of the sweep benchmark")
+    parser.add_argument('--quick', action='store_true', help="small maps only, for a fast check")
+    arguments = parser.parse_args()
+    results = runBenchmarks(quickMapSizes if arguments.quick and not arguments.sizes else arguments.sizes,
+                            arguments.steps, arguments.engines, arguments.workers)
+    with open(arguments.output, 'w') as outputFile:
+        json.dump(results, outputFile, indent=2)
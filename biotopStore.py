@@ -0,0 +1,158 @@
+import struct
+import zlib
+
+import numpy as np
+
+# one local file for the biotop maps of a whole sweep, indexed by (scenario, timestep):
+#   header  magic, encoding, nrOfScenarios, nrOfTimeSteps, nrRows, nrCols, offset of the footer
+#   chunks  one zlib compressed map per (scenario, timestep), in the order they were written
+#   footer  index with offset and length of every chunk (0 length = not written) and the (h, n, f) parameters
+STORE_MAGIC = b'BIOTOPS1'
+STORE_HEADER = struct.Struct('<8sBIIIIQ')
+
+# 2-bit packs 4 cells into a byte (values 0 to 2, 3 marks missing values), uint8 stores the map as is
+ENCODINGS = {'uint8': 0, '2bit': 1}
+MISSING_2BIT = 3
+MV_UINT1 = 255
+
+
+def packBiotop(biotop):
+    flat = np.ravel(biotop).astype(np.uint8)
+    flat = np.where(flat == MV_UINT1, MISSING_2BIT, flat).astype(np.uint8)
+    padded = np.zeros(-(-flat.size // 4) * 4, dtype=np.uint8)
+    padded[:flat.size] = flat
+    return padded[0::4] | (padded[1::4] << 2) | (padded[2::4] << 4) | (padded[3::4] << 6)
+
+
+def unpackBiotop(packed, shape):
+    packed = np.frombuffer(packed, dtype=np.uint8)
+    flat = np.empty(packed.size * 4, dtype=np.uint8)
+    for shift in range(4):
+        flat[shift::4] = (packed >> (2 * shift)) & 3
+    flat = flat[:shape[0] * shape[1]]
+    flat[flat == MISSING_2BIT] = MV_UINT1
+    return flat.reshape(shape)
+
+
+def encodeChunk(biotop, encoding='2bit', level=6):
+    raw = packBiotop(biotop) if encoding == '2bit' else np.ascontiguousarray(biotop, dtype=np.uint8)
+    return zlib.compress(raw.tobytes(), level)
+
+
+def decodeChunk(chunk, shape, encoding='2bit'):
+    raw = zlib.decompress(chunk)
+    if encoding == '2bit':
+        return unpackBiotop(raw, shape)
+    return np.frombuffer(raw, dtype=np.uint8).reshape(shape).copy()
+
+
+class BiotopStore:
+    # mode 'w' creates the file for a (nrOfScenarios, nrOfTimeSteps, nrRows, nrCols) stack, mode 'r' opens it for
+    # random access by scenario and timestep. Timesteps count from 1, like the timesteps of a run
+    def __init__(self, path, mode='r', shape=None, parameters=None, encoding='2bit', level=6):
+        self.path = path
+        self.mode = mode
+        if mode == 'w':
+            if shape is None:
+                raise ValueError("a new store needs its (scenarios, timesteps, rows, cols) shape")
+            if encoding not in ENCODINGS:
+                raise ValueError("unknown encoding %r, use one of %s" % (encoding, ", ".join(ENCODINGS)))
+            self.shape = tuple(int(size) for size in shape)
+            self.encoding = encoding
+            self.level = level
+            self.index = np.zeros(self.shape[:2] + (2,), dtype=np.uint64)
+            self.parameters = None if parameters is None else np.asarray(parameters, dtype=np.float64).reshape(-1, 3)
+            self.file = open(path, 'wb')
+            self.file.write(STORE_HEADER.pack(STORE_MAGIC, ENCODINGS[encoding], *self.shape, 0))
+        elif mode == 'r':
+            self.file = open(path, 'rb')
+            magic, encoding, *shape, footer = STORE_HEADER.unpack(self.file.read(STORE_HEADER.size))
+            if magic != STORE_MAGIC:
+                raise ValueError("%s is not a biotop store" % path)
+            if footer == 0:
+                raise ValueError("%s was not closed properly, its index is missing" % path)
+            self.shape = tuple(shape)
+            self.encoding = {code: name for name, code in ENCODINGS.items()}[encoding]
+            self.file.seek(footer)
+            self.index = np.load(self.file)
+            parameters = np.load(self.file)
+            self.parameters = parameters if parameters.size else None
+        else:
+            raise ValueError("unknown mode %r, use 'r' or 'w'" % mode)
+
+    def write(self, scenario, timestep, biotop):
+        self.writeChunk(scenario, timestep, encodeChunk(biotop, self.encoding, self.level))
+
+    def writeChunk(self, scenario, timestep, chunk):
+        #chunk has to be encoded with the encoding of this store, see encodeChunk()
+        offset = self.file.tell()
+        self.file.write(chunk)
+        self.index[scenario, timestep - 1] = (offset, len(chunk))
+
+    def read(self, scenario, timestep):
+        offset, length = self.index[scenario, timestep - 1]
+        if length == 0:
+            raise KeyError("no map stored for scenario %d at timestep %d" % (scenario, timestep))
+        self.file.seek(int(offset))
+        return decodeChunk(self.file.read(int(length)), self.shape[2:], self.encoding)
+
+    def written(self, scenario, timestep):
+        return bool(self.index[scenario, timestep - 1, 1])
+
+    def readSeries(self, scenario):
+        #all stored timesteps of one scenario as (timesteps, rows, cols), missing maps are MV_UINT1
+        series = np.full((self.shape[1],) + self.shape[2:], MV_UINT1, dtype=np.uint8)
+        for timestep in range(1, self.shape[1] + 1):
+            if self.written(scenario, timestep):
+                series[timestep - 1] = self.read(scenario, timestep)
+        return series
+
+    def readTimestep(self, timestep):
+        #one timestep of all scenarios as (scenarios, rows, cols), missing maps are MV_UINT1
+        maps = np.full((self.shape[0],) + self.shape[2:], MV_UINT1, dtype=np.uint8)
+        for scenario in range(self.shape[0]):
+            if self.written(scenario, timestep):
+                maps[scenario] = self.read(scenario, timestep)
+        return maps
+
+    def close(self):
+        if self.file.closed:
+            return
+        if self.mode == 'w':
+            footer = self.file.tell()
+            np.save(self.file, self.index)
+            np.save(self.file, np.empty((0, 3)) if self.parameters is None else self.parameters)
+            self.file.seek(0)
+            self.file.write(STORE_HEADER.pack(STORE_MAGIC, ENCODINGS[self.encoding], *self.shape, footer))
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class ChunkCollector:
+    # reporter for ShrubEngine.run() in sweep workers: the maps a ReportPolicy selects are encoded right away and
+    # kept as (cell, timestep, chunk) until the sweep writes them to its BiotopStore
+    def __init__(self, policy, encoding='2bit', level=6):
+        self.policy = policy
+        self.encoding = encoding
+        self.level = level
+        self.chunks = []
+
+    def wants(self, timestep, nrOfTimeSteps, cell=None, final=False):
+        return self.policy.wants(timestep, nrOfTimeSteps, cell, final)
+
+    def report(self, biotop, timestep, cell=None):
+        self.chunks.append((cell, timestep, encodeChunk(biotop, self.encoding, self.level)))
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
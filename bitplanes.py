@@ -0,0 +1,84 @@
+import numpy as np
+
+# the biotop as two bitplanes, one for grass and one for shrubs (empty cells are in neither), every row packed into
+# 64 bit words with cell x in bit x % 64 of word x // 64 and the bits after the last cell of a row kept at 0.
+# A map takes 2 bits per cell, and the von Neumann neighbour counts of 64 cells come from a few bitwise operations
+# on shifted words (see neighbourCount())
+WORD = 64
+
+
+def words(cols):
+    return -(-cols // WORD)
+
+
+def packPlane(mask):
+    #(..., rows, cols) bool mask as (..., rows, words) uint64 bitplane
+    mask = np.asarray(mask, dtype=bool)
+    packed = np.packbits(mask, axis=-1, bitorder='little')
+    padded = np.zeros(mask.shape[:-1] + (words(mask.shape[-1]) * 8,), dtype=np.uint8)
+    padded[..., :packed.shape[-1]] = packed
+    return padded.view('<u8')
+
+
+def unpackPlane(plane, cols):
+    #(..., rows, cols) 0/1 uint8 map of a bitplane
+    return np.unpackbits(np.ascontiguousarray(plane).view(np.uint8), axis=-1, count=cols, bitorder='little')
+
+
+def packBitplanes(biotop, grass=1, shrub=2):
+    #grass and shrub bitplanes of a biotop map or stack
+    biotop = np.asarray(biotop)
+    return packPlane(biotop == grass), packPlane(biotop == shrub)
+
+
+def unpackBitplanes(grass, shrub, cols):
+    #biotop (0 empty, 1 grass, 2 shrub) of the bitplanes, cols is the number of cells of a row
+    biotop = unpackPlane(shrub, cols)
+    biotop <<= 1
+    biotop |= unpackPlane(grass, cols)
+    return biotop
+
+
+def shifted(plane):
+    #the four von Neumann neighbours of every cell as planes: the cell above, below, left and right of it,
+    #cells outside the map are 0
+    above = np.zeros_like(plane)
+    above[..., 1:, :] = plane[..., :-1, :]
+    below = np.zeros_like(plane)
+    below[..., :-1, :] = plane[..., 1:, :]
+    left = plane << np.uint64(1)
+    left[..., 1:] |= plane[..., :-1] >> np.uint64(WORD - 1)
+    right = plane >> np.uint64(1)
+    right[..., :-1] |= plane[..., 1:] << np.uint64(WORD - 1)
+    return above, below, left, right
+
+
+def neighbourCount(plane):
+    #number of von Neumann neighbours (0 to 4) of every cell that are set in plane, as three bitplanes with the
+    #bits of weight 1, 2 and 4 of the count, added with two half adders and a full adder over 64 cells at a time
+    above, below, left, right = shifted(plane)
+    verticalSum = above ^ below
+    verticalCarry = above & below
+    horizontalSum = left ^ right
+    horizontalCarry = left & right
+    ones = verticalSum ^ horizontalSum
+    sumCarry = verticalSum & horizontalSum
+    twos = verticalCarry ^ horizontalCarry ^ sumCarry
+    fours = (verticalCarry & horizontalCarry) | (sumCarry & (verticalCarry ^ horizontalCarry))
+    return ones, twos, fours
+
+
+def countMap(planes, cols):
+    #(..., rows, cols) uint8 map of the count given as bitplanes (ones, twos, fours)
+    ones, twos, fours = planes
+    count = unpackPlane(fours, cols)
+    count <<= 1
+    count |= unpackPlane(twos, cols)
+    count <<= 1
+    count |= unpackPlane(ones, cols)
+    return count
+
+
+def popcount(plane):
+    #number of set cells of every map of a (..., rows, words) plane
+    return np.bitwise_count(plane).sum(axis=(-2, -1), dtype=np.int64)
@@ -0,0 +1,93 @@
+import hashlib
+import os
+import struct
+
+import numpy as np
+
+from mapReport import CR_UINT1, CSF_HEADER_SIZE, CSF_SIGNATURE, MV_UINT1
+from shrubEngine import SHRUB
+
+# parsed initial states are kept as .npy sidecars named by the hash of the source file, so every map or ASCII
+# grid is only parsed once and every later load is a memory map of the sidecar
+CACHE_DIRECTORY = '.stateCache'
+
+# content hash of every source file loaded in this process, keyed by (path, size, modification time)
+fileHashes = {}
+
+
+def readMap(path):
+    #reads a PCRaster map with UINT1 cells (like initialStateA.map) into a 2-D uint8 array
+    with open(path, 'rb') as mapFile:
+        header = mapFile.read(CSF_HEADER_SIZE)
+        if not header.startswith(CSF_SIGNATURE):
+            raise ValueError("%s is not a PCRaster map" % path)
+        valueScale, cellRepr = struct.unpack_from('<HH', header, 64)
+        nrRows, nrCols = struct.unpack_from('<II', header, 100)
+        if cellRepr != CR_UINT1:
+            raise ValueError("%s has cell representation 0x%02x, only UINT1 maps hold a biotop" % (path, cellRepr))
+        biotop = np.frombuffer(mapFile.read(nrRows * nrCols), dtype=np.uint8)
+    if biotop.size != nrRows * nrCols:
+        raise ValueError("%s is truncated" % path)
+    return biotop.reshape(nrRows, nrCols)
+
+
+def readAscii(path):
+    #reads a tab-separated grid like AscFileStateA.txt, trailing tabs and empty lines at the end are ignored
+    #and empty cells become missing values
+    rows = []
+    with open(path) as asciiFile:
+        for line in asciiFile:
+            fields = line.rstrip('\r\n').rstrip('\t').split('\t')
+            if fields == ['']:
+                continue
+            rows.append([int(field) if field.strip() else MV_UINT1 for field in fields])
+    if not rows:
+        raise ValueError("%s holds no grid" % path)
+    for number, row in enumerate(rows, start=1):
+        if len(row) != len(rows[0]):
+            raise ValueError("%s is not a rectangular grid, row %d has %d cells instead of %d"
+                             % (path, number, len(row), len(rows[0])))
+    return np.array(rows, dtype=np.uint8)
+
+
+def checkBiotop(biotop, path):
+    #the engines only step empty, grass and shrub cells, so a grid with missing values (MV_UINT1, e.g. empty
+    #fields of an ASCII grid) or other classes is rejected instead of being stepped as if they were shrubs
+    invalid = np.count_nonzero(biotop > SHRUB)
+    if invalid:
+        missing = np.count_nonzero(biotop == MV_UINT1)
+        raise ValueError("%s has %d cells that are not empty, grass or shrub (%d missing values)"
+                         % (path, invalid, missing))
+
+
+def fileHash(path):
+    info = os.stat(path)
+    key = (os.path.abspath(path), info.st_size, info.st_mtime_ns)
+    if key not in fileHashes:
+        digest = hashlib.sha1()
+        with open(path, 'rb') as sourceFile:
+            for block in iter(lambda: sourceFile.read(1 << 20), b''):
+                digest.update(block)
+        fileHashes[key] = digest.hexdigest()
+    return fileHashes[key]
+
+
+def loadInitialState(path, cacheDirectory=None):
+    #returns the biotop of a .map file or tab-separated ASCII grid as read-only memory map of its .npy sidecar,
+    #ShrubEngine.reset() copies it into the state buffer of a run. The sidecar goes to .stateCache next to the
+    #source file unless cacheDirectory is given. Grids with cells other than empty, grass or shrub raise ValueError
+    if cacheDirectory is None:
+        cacheDirectory = os.path.join(os.path.dirname(os.path.abspath(path)), CACHE_DIRECTORY)
+    sidecar = os.path.join(cacheDirectory, fileHash(path) + '.npy')
+    if not os.path.exists(sidecar):
+        with open(path, 'rb') as sourceFile:
+            isMap = sourceFile.read(len(CSF_SIGNATURE)) == CSF_SIGNATURE
+        biotop = readMap(path) if isMap else readAscii(path)
+        checkBiotop(biotop, path)
+        os.makedirs(cacheDirectory, exist_ok=True)
+        #written under a temporary name first, so sweep workers never see half a sidecar
+        temporary = "%s.%d.tmp" % (sidecar, os.getpid())
+        with open(temporary, 'wb') as sidecarFile:
+            np.save(sidecarFile, biotop)
+        os.replace(temporary, sidecar)
+    return np.load(sidecar, mmap_mode='r')
@@ -0,0 +1,149 @@
+import json
+import time
+
+# phases of a timestep timed by a Profiler, in the order they happen:
+#   checkpoint     saveCheckpoint() of run()
+#   density        recording the shrub densities in run() and counting the states after every step
+#   report         handing the maps to the reporter (a BufferedMapWriter only blocks once its queue is full)
+#   compact        moving the scenarios that are still running to the front of the buffers
+#   random         drawing the random fields of the transitions
+#   neighbourhood  neighbour codes (window4total) and the transition tables of the step
+#   grass          first table lookup: grass growth and death, and shrub death, which is decided by the same draw
+#   shrub          second table lookup: shrub growth on empty and grass cells, and the new states
+#   removal        mechanical removal events
+#   counting       counting the transitions, only done if the profiler asks for them
+#   bands          the bands of a ThreadedShrubEngine step, run on all of its threads at once
+#   tiles          the tiles of a TiledShrubEngine step, their reads, lookups and writes
+phases = ('checkpoint', 'density', 'report', 'compact', 'random', 'neighbourhood', 'grass', 'shrub', 'removal',
+          'counting', 'bands', 'tiles')
+# transitions counted by a Profiler, named like the transition functions of shrubEngine.py, removed counts the
+# shrubs cleared by mechanical removal
+transitions = ('empty2grass', 'grass2empty', 'empty2shrub', 'grass2shrub', 'shrub2empty', 'removed')
+
+
+class NullProfiler:
+    # profiler of an engine without one, every call does nothing so an unprofiled step only pays a few method calls
+    countTransitions = False
+
+    def start(self):
+        pass
+
+    def lap(self, phase):
+        pass
+
+    def count(self, counts):
+        pass
+
+    def endStep(self, engine):
+        pass
+
+    def startRun(self, engine, nrOfTimeSteps):
+        pass
+
+    def endRun(self, engine):
+        pass
+
+    def close(self):
+        pass
+
+
+nullProfiler = NullProfiler()
+
+
+class Profiler:
+    # timers and counters of the phases of every step of the engines it is given to (ShrubEngine(profiler=...),
+    # forks and branches of an engine share its profiler). seconds and transitions hold the totals of all steps
+    #
+    # every step, and every run() of an engine, gives a record (a dict) to each of the hooks, callables that take
+    # the record, and with a trace path also appends it to that JSON-lines file. Records have an event:
+    #   'run'   a run starts: engine class, timestep, nrOfTimeSteps, scenarios, mapShape, removal
+    #   'step'  a step is done: timestep (after the step), scenarios, seconds by phase and transitions by type of
+    #           this step, summed over its scenarios. The density and report phases of run() before a step count
+    #           for that step
+    #   'end'   the run is done: steps, seconds and transitions of the whole run
+    # so every run() is one block of lines from its 'run' to its 'end' record in the trace. The trace file is opened
+    # by the first record after close(), run() closes it when it returns or fails, steps driven by step() alone are
+    # written line by line until close() is called
+    #
+    # countTransitions=False leaves out counting the cells of every transition, which costs a pass over the keys
+    def __init__(self, hooks=(), trace=None, countTransitions=True):
+        self.hooks = list(hooks)
+        self.trace = trace
+        self.countTransitions = countTransitions
+        self.seconds = dict.fromkeys(phases, 0.0)
+        self.transitions = dict.fromkeys(transitions, 0)
+        self.steps = 0
+        #seconds and transitions since the last record
+        self.stepSeconds = {}
+        self.stepTransitions = {}
+        self.last = time.perf_counter()
+        self.runStart = None
+        self.traceFile = None
+
+    def start(self):
+        #the next lap() is timed from now
+        self.last = time.perf_counter()
+
+    def lap(self, phase):
+        #the time since the last start() or lap() counts for phase
+        now = time.perf_counter()
+        self.stepSeconds[phase] = self.stepSeconds.get(phase, 0.0) + (now - self.last)
+        self.last = now
+
+    def count(self, counts):
+        #adds the {transition: cells} counts to the step
+        for transition, cells in counts.items():
+            self.stepTransitions[transition] = self.stepTransitions.get(transition, 0) + int(cells)
+
+    def emit(self, record):
+        for hook in self.hooks:
+            hook(record)
+        if self.trace is not None:
+            if self.traceFile is None:
+                self.traceFile = open(self.trace, 'a', buffering=1)
+            self.traceFile.write(json.dumps(record) + "\n")
+
+    def collect(self):
+        #seconds and transitions since the last record, added to the totals
+        seconds, counts = self.stepSeconds, self.stepTransitions
+        for phase, value in seconds.items():
+            self.seconds[phase] = self.seconds.get(phase, 0.0) + value
+        for transition, cells in counts.items():
+            self.transitions[transition] = self.transitions.get(transition, 0) + cells
+        self.stepSeconds = {}
+        self.stepTransitions = {}
+        return seconds, counts
+
+    def endStep(self, engine):
+        self.steps = self.steps + 1
+        seconds, counts = self.collect()
+        self.emit({'event': 'step', 'timestep': engine.timestep, 'scenarios': len(engine.scenario),
+                   'seconds': seconds, 'transitions': counts})
+
+    def startRun(self, engine, nrOfTimeSteps):
+        self.collect()
+        self.runStart = (self.steps, dict(self.seconds), dict(self.transitions))
+        self.emit({'event': 'run', 'engine': type(engine).__name__, 'timestep': engine.timestep,
+                   'nrOfTimeSteps': nrOfTimeSteps, 'scenarios': len(engine.scenario),
+                   'mapShape': list(engine.mapShape), 'removal': engine.removal})
+        self.start()
+
+    def endRun(self, engine):
+        self.collect()
+        steps, seconds, counts = self.runStart
+        self.emit({'event': 'end', 'timestep': engine.timestep, 'steps': self.steps - steps,
+                   'seconds': {phase: value - seconds.get(phase, 0.0) for phase, value in self.seconds.items()},
+                   'transitions': {name: value - counts.get(name, 0) for name, value in self.transitions.items()}})
+
+    def close(self):
+        if self.traceFile is not None:
+            self.traceFile.close()
+            self.traceFile = None
+
+    def table(self):
+        #the total seconds of every phase that took any time and its share of all of them, as lines of text
+        total = sum(self.seconds.values()) or 1.0
+        lines = ["%-14s %10.4f s  %5.1f %%" % (phase, value, 100 * value / total)
+                 for phase, value in sorted(self.seconds.items(), key=lambda item: -item[1]) if value]
+        lines.extend("%-14s %10d cells" % (name, cells) for name, cells in self.transitions.items() if cells)
+        return "\n".join(lines)
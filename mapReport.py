@@ -0,0 +1,117 @@
+import os
+import queue
+import struct
+import threading
+
+import numpy as np
+
+# PCRaster (CSF version 2) nominal UINT1 maps, the format of initialStateA.map and of self.report()
+CSF_SIGNATURE = b'RUU CROSS SYSTEM MAP FORMAT'
+CSF_HEADER_SIZE = 256
+VS_NOMINAL = 0xe2
+CR_UINT1 = 0x00
+MV_UINT1 = 255
+
+
+def mapName(name, timestep):
+    #same file names as pcraster's report() in a DynamicModel, e.g. biotop00.001
+    return "%s.%03d" % (name.ljust(8, '0'), timestep)
+
+
+def writeMap(path, biotop, xUL=0.0, yUL=0.0, cellSize=1.0):
+    #writes a 2-D uint8 array as nominal PCRaster map, MV_UINT1 cells are missing values
+    biotop = np.ascontiguousarray(biotop, dtype=np.uint8)
+    nrRows, nrCols = biotop.shape
+    values = biotop[biotop != MV_UINT1]
+    minValue = int(values.min()) if values.size else MV_UINT1
+    maxValue = int(values.max()) if values.size else MV_UINT1
+    header = bytearray(CSF_HEADER_SIZE)
+    header[:len(CSF_SIGNATURE)] = CSF_SIGNATURE
+    #version, gisFileId, projection (y increases downwards), attrTable, mapType (raster), byteOrder
+    struct.pack_into('<HIHIHI', header, 32, 2, 0, 1, 0, 1, 1)
+    struct.pack_into('<HH', header, 64, VS_NOMINAL, CR_UINT1)
+    #minimum and maximum are 8 byte fields of which a UINT1 map only uses the first byte
+    header[68:84] = bytes([minValue]) + b'\xff' * 7 + bytes([maxValue]) + b'\xff' * 7
+    struct.pack_into('<ddIIddd', header, 84, xUL, yUL, nrRows, nrCols, cellSize, cellSize, 0.0)
+    with open(path, 'wb') as mapFile:
+        mapFile.write(header)
+        mapFile.write(biotop.tobytes())
+
+
+class ReportPolicy:
+    # decides which biotop maps of a run are written:
+    # mode 'off' writes nothing, 'every' writes every k-th timestep (every=k), 'final' only the last timestep
+    # of a run, and cells limits reporting to the given (idx, idy) parameter cells (None means all cells)
+    # maps go to PCRaster map files in directory, or with store set to a file name, into one compressed
+    # biotopStore.BiotopStore for the whole sweep
+    def __init__(self, mode='off', every=1, cells=None, directory='.', name='biotop', store=None):
+        if mode not in ('off', 'every', 'final'):
+            raise ValueError("unknown report mode %r, use 'off', 'every' or 'final'" % mode)
+        self.mode = mode
+        self.every = every
+        self.cells = None if cells is None else set(tuple(cell) for cell in cells)
+        self.directory = directory
+        self.name = name
+        self.store = store
+
+    def wants(self, timestep, nrOfTimeSteps, cell=None, final=False):
+        if self.mode == 'off':
+            return False
+        if self.cells is not None and cell not in self.cells:
+            return False
+        if self.mode == 'final':
+            return final or timestep == nrOfTimeSteps
+        return timestep % self.every == 0
+
+    def path(self, timestep, cell=None):
+        #maps of a sweep cell go to a sub directory idx_idy so runs do not overwrite each other
+        directory = self.directory if cell is None else os.path.join(self.directory, "%d_%d" % tuple(cell))
+        return os.path.join(directory, mapName(self.name, timestep))
+
+
+class BufferedMapWriter:
+    # writes the maps selected by a ReportPolicy on a background thread, so the model keeps stepping while the
+    # maps are written. report() copies the map and only blocks once maxPending maps are waiting to be written
+    def __init__(self, policy, maxPending=64):
+        self.policy = policy
+        self.pending = queue.Queue(maxsize=maxPending)
+        self.thread = None
+        self.error = None
+
+    def wants(self, timestep, nrOfTimeSteps, cell=None, final=False):
+        return self.policy.wants(timestep, nrOfTimeSteps, cell, final)
+
+    def report(self, biotop, timestep, cell=None):
+        if self.error is not None:
+            raise self.error
+        if self.thread is None:
+            self.thread = threading.Thread(target=self.writeLoop, daemon=True)
+            self.thread.start()
+        self.pending.put((self.policy.path(timestep, cell), np.array(biotop, dtype=np.uint8)))
+
+    def writeLoop(self):
+        while True:
+            item = self.pending.get()
+            if item is None:
+                return
+            path, biotop = item
+            try:
+                os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+                writeMap(path, biotop)
+            except OSError as error:
+                self.error = error
+
+    def close(self):
+        #waits until all maps are written
+        if self.thread is not None:
+            self.pending.put(None)
+            self.thread.join()
+            self.thread = None
+        if self.error is not None:
+            raise self.error
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
@@ -0,0 +1,128 @@
+import numpy as np
+
+from bitplanes import countMap, neighbourCount, packBitplanes, popcount, unpackBitplanes, words
+from randomStreams import TRANSITION, uniform
+from removal import ShrubCells, strategies
+from shrubEngine import (EMPTY, GRASS, KEYS, SHRUB, GrassFraction, ShrubEngine, outcomeTable, transitionCounts,
+                         transitionTables)
+
+
+class PackedShrubEngine(ShrubEngine):
+    # ShrubEngine that keeps the maps of all scenarios as grass and shrub bitplanes (see bitplanes.py), 2 bits per
+    # cell instead of the byte of the state and the 20 bytes of the step buffers ShrubEngine has for every cell of
+    # every scenario. Scenarios are stepped one after the other in the buffers of a single map, so a large batch or
+    # a large map needs a fraction of the memory
+    #
+    # the neighbour codes come from bitwise neighbour counts on the planes, the transitions are the table lookups
+    # of ShrubEngine with the same random fields, so results are the same as ShrubEngine's. Checkpoints store the
+    # bitplanes as they are
+    stateBuffers = ('grassPlane', 'shrubPlane')
+
+    def allocate(self, shape):
+        rows, cols = shape[1:]
+        #buffers of the step of one scenario
+        self.work = {
+            'random': np.empty((rows, cols), dtype=np.float32),
+            'threshold': np.empty((rows, cols), dtype=np.float32),
+            'code': np.empty((rows, cols), dtype=np.uint8),
+            'key': np.empty((rows, cols), dtype=np.intp),
+            'shrub': np.empty((rows, cols), dtype=bool),
+            'change': np.empty((rows, cols), dtype=bool),
+        }
+        return {
+            'grassPlane': np.zeros(shape[:2] + (words(cols),), dtype=np.uint64),
+            'shrubPlane': np.zeros(shape[:2] + (words(cols),), dtype=np.uint64),
+        }
+
+    @property
+    def state(self):
+        #unpacked maps of the running scenarios
+        return unpackBitplanes(self.grassPlane, self.shrubPlane, self.mapShape[1])
+
+    @property
+    def biotop(self):
+        grass, shrub = self.buffers['grassPlane'], self.buffers['shrubPlane']
+        if not self.batched:
+            grass, shrub = grass[0], shrub[0]
+        return unpackBitplanes(grass, shrub, self.mapShape[1])
+
+    def loadMaps(self, maps):
+        grass, shrub = packBitplanes(maps)
+        self.buffers['grassPlane'][:len(maps)] = grass
+        self.buffers['shrubPlane'][:len(maps)] = shrub
+        self.useScenarios(len(maps))
+
+    def scenarioMap(self, position):
+        return unpackBitplanes(self.grassPlane[position], self.shrubPlane[position], self.mapShape[1])
+
+    def countStates(self):
+        grass = popcount(self.grassPlane)
+        shrub = popcount(self.shrubPlane)
+        self.counts = np.stack([self.cellsPerMap() - grass - shrub, grass, shrub], axis=1)
+
+    def packedState(self):
+        return 'bitplanes', np.stack([self.grassPlane, self.shrubPlane])
+
+    def step(self):
+        profiler = self.profiler
+        profiler.start()
+        cols = self.mapShape[1]
+        random = self.work['random']
+        threshold = self.work['threshold']
+        code = self.work['code']
+        key = self.work['key']
+        shrub = self.work['shrub']
+        change = self.work['change']
+        pg = self.counts[:, GRASS] / self.cellsPerMap()
+        first, second = transitionTables(self, GrassFraction(pg))
+        outcome = np.tile(outcomeTable, len(pg))
+        self.year = self.year + 1
+        remove = strategies[self.removal]
+        profiler.lap('neighbourhood')
+        for position, stream in enumerate(self.streams):
+            grassPlane = self.grassPlane[position]
+            shrubPlane = self.shrubPlane[position]
+            uniform(stream, self.timestep, TRANSITION, random)
+            profiler.lap('random')
+            #code = 5 * shrub neighbours + grass neighbours, counted on the bitplanes
+            np.multiply(countMap(neighbourCount(shrubPlane), cols), 5, out=code)
+            np.add(code, countMap(neighbourCount(grassPlane), cols), out=code)
+            profiler.lap('neighbourhood')
+
+            #same table lookups as ShrubEngine.step()
+            biotop = unpackBitplanes(grassPlane, shrubPlane, cols)
+            np.multiply(biotop, 25, out=key)
+            np.add(key, code, out=key)
+            np.add(key, position * KEYS, out=key)
+            np.take(first, key, out=threshold, mode='clip')
+            np.less(random, threshold, out=change)
+            profiler.lap('grass')
+            np.multiply(key, 2, out=key)
+            np.add(key, change, out=key)
+            np.take(second, key, out=threshold, mode='clip')
+            np.less(random, threshold, out=change)
+            np.multiply(key, 2, out=key)
+            np.add(key, change, out=key)
+            #mechanical removal event every nth year, only on cells that were shrubs at the start of the step
+            removing = self.year[position] == self.n[position]
+            if removing:
+                shrubs = ShrubCells.fromMask(np.equal(biotop, SHRUB, out=shrub))
+            np.take(outcome, key, out=biotop, mode='clip')
+            profiler.lap('shrub')
+            if profiler.countTransitions:
+                profiler.count(transitionCounts(key, len(pg)))
+                profiler.lap('counting')
+
+            if removing:
+                cells = remove(shrubs, self.f[position], stream, self.timestep)
+                if profiler.countTransitions:
+                    profiler.count({'removed': np.count_nonzero(biotop.reshape(-1)[cells])})
+                biotop.reshape(-1)[cells] = EMPTY
+                self.year[position] = 0
+                profiler.lap('removal')
+            grassPlane[:], shrubPlane[:] = packBitplanes(biotop)
+            profiler.lap('shrub')
+        self.timestep = self.timestep + 1
+        self.countStates()
+        profiler.lap('density')
+        profiler.endStep(self)
@@ -0,0 +1,215 @@
+import numpy as np
+
+SHRUB = 2
+
+# the 8 cells around a cell, clockwise from the upper left, every cell of the ring is a von Neumann neighbour of
+# the next one. Orthogonal are the ones at odd positions (above, right, below, left of the centre)
+RING = [(-1, -1), (-1, 0), (-1, 1), (0, 1), (1, 1), (1, 0), (1, -1), (0, -1)]
+
+
+def ringComponents(code):
+    #number of connected runs of shrub cells around the ring (bit i = RING[i] is a shrub) that touch the centre
+    shrub = [bool(code >> i & 1) for i in range(8)]
+    if all(shrub):
+        return 1
+    start = shrub.index(False)
+    components = 0
+    touching = False
+    for i in range(start, start + 9):
+        if shrub[i % 8]:
+            touching = touching or i % 2 == 1
+        elif touching:
+            components = components + 1
+            touching = False
+    return components
+
+
+# a shrub cell that dies does not split its patch if the shrubs next to it stay connected through the ring around
+# it, e.g. a cell at the end of a line or in a corner, so its patch needs no new labels (see ShrubPatches.update())
+SIMPLE = np.array([ringComponents(code) <= 1 for code in range(256)])
+
+
+def neighbourPairs(mask, dirty=None, horizontal=True):
+    #flat indices (a, b) of all pairs of right and lower von Neumann neighbours that are both in mask,
+    #only pairs with at least one cell in dirty if it is given and only lower ones without horizontal
+    cols = mask.shape[1]
+    lower = mask[:-1] & mask[1:]
+    if dirty is not None:
+        lower &= dirty[:-1] | dirty[1:]
+    #a lower pair has the flat index of its upper cell, a right pair is numbered in a map one column narrower
+    a = np.flatnonzero(lower)
+    b = a + cols
+    if horizontal:
+        right = mask[:, :-1] & mask[:, 1:]
+        if dirty is not None:
+            right &= dirty[:, :-1] | dirty[:, 1:]
+        left = np.flatnonzero(right)
+        left = left + left // (cols - 1)
+        a = np.concatenate([left, a])
+        b = np.concatenate([left + 1, b])
+    return a, b
+
+
+def rowRuns(mask, cells):
+    #compressed forest in which every horizontal run of the cells in mask points to its first cell
+    first = mask.copy()
+    first[:, 1:] &= ~mask[:, :-1]
+    first = first.ravel()
+    parent = np.arange(mask.size)
+    parent[cells] = np.flatnonzero(first)[np.cumsum(first)[cells] - 1]
+    return parent
+
+
+def compress(parent, cells):
+    #pointer jumping in place until all cells point to the root of their tree, cells that reached it drop out
+    while len(cells):
+        grandparent = parent[parent[cells]]
+        moved = grandparent != parent[cells]
+        parent[cells] = grandparent
+        cells = cells[moved]
+
+
+def union(parent, a, b, cells):
+    #joins the trees of all pairs (a, b) in the compressed forest parent over cells: in every round the larger root
+    #of every pair that is still in two trees is hooked below the smaller one, then the forest is compressed again
+    while len(a):
+        rootA = parent[a]
+        rootB = parent[b]
+        apart = rootA != rootB
+        a, b, rootA, rootB = a[apart], b[apart], rootA[apart], rootB[apart]
+        if not len(a):
+            break
+        hooked = np.maximum(rootA, rootB)
+        np.minimum.at(parent, hooked, np.minimum(rootA, rootB))
+        #only the hooked roots form chains, every other cell still points to a root of the last round
+        compress(parent, hooked)
+        parent[cells] = parent[parent[cells]]
+
+
+def cellPatches(cells, cols):
+    #patch of every one of the sorted flat indices cells of the shrubs of a map with cols columns, as the position
+    #in cells of the first cell of its patch. Runs of a row and the pairs of cells above each other are found in
+    #cells alone, so labelling costs in the number of shrubs, not in the size of the map
+    positions = np.arange(len(cells))
+    first = np.ones(len(cells), dtype=bool)
+    first[1:] = (np.diff(cells) != 1) | (cells[1:] % cols == 0)
+    parent = np.flatnonzero(first)[np.cumsum(first) - 1]
+    below = np.minimum(np.searchsorted(cells, cells + cols), len(cells) - 1)
+    above = cells[below] == cells + cols
+    union(parent, positions[above], below[above], positions)
+    return parent
+
+
+class ShrubPatches:
+    # connected shrub patches (biotop == 2, 4-neighbourhood) of one map as a union-find forest over the flat cell
+    # indices: parent holds the root of every shrub cell, so two shrub cells are in the same patch if they have
+    # the same root (cells that are no shrub point to themselves and are not counted)
+    #
+    # update() follows the map from step to step: new shrub cells are joined with their neighbours and only the
+    # patches that lost a cell are taken apart and joined again, since a patch can split where a cell died
+    def __init__(self, biotop):
+        self.label(np.asarray(biotop) == SHRUB)
+
+    def label(self, shrub):
+        #labels all patches from scratch, the runs of every row are joined in one pass and only the pairs of
+        #cells above each other go through union()
+        cells = np.flatnonzero(shrub)
+        self.shrub = shrub
+        self.parent = rowRuns(shrub, cells)
+        union(self.parent, *neighbourPairs(shrub, horizontal=False), cells)
+
+    def update(self, biotop):
+        shrub = np.asarray(biotop) == SHRUB
+        died = (self.shrub & ~shrub).ravel()
+        #every cell of a patch that might have been split starts over as its own tree, like every new shrub cell
+        affected = np.zeros(shrub.size, dtype=bool)
+        affected[self.parent[self.splitting(shrub, died)]] = True
+        oldCells = np.flatnonzero(self.shrub)
+        dirty = (shrub & ~self.shrub).ravel()
+        dirty[oldCells] |= affected[self.parent[oldCells]]
+        cells = np.flatnonzero(shrub)
+        if np.count_nonzero(dirty) > len(cells) // 2:
+            #with most patches to be joined again (like a patch spanning the map), labelling all is faster
+            self.label(shrub)
+            return
+        self.parent[dirty] = np.flatnonzero(dirty)
+        self.shrub = shrub
+        union(self.parent, *neighbourPairs(shrub, dirty.reshape(shrub.shape)), cells)
+
+    def splitting(self, shrub, died):
+        #cells that died and may have split their patch: all but the deaths with no other death among their
+        #8 neighbours whose ring of shrubs stays connected, and any death of the root of a patch
+        cols = shrub.shape[1]
+        cells = np.flatnonzero(died)
+        if not len(cells):
+            return cells
+        y, x = np.divmod(cells, cols)
+        paddedShrub = np.pad(shrub, 1)
+        paddedDied = np.pad(died.reshape(shrub.shape), 1)
+        code = np.zeros(len(cells), dtype=np.intp)
+        crowded = np.zeros(len(cells), dtype=bool)
+        for bit, (dy, dx) in enumerate(RING):
+            code |= paddedShrub[y + 1 + dy, x + 1 + dx].astype(np.intp) << bit
+            crowded |= paddedDied[y + 1 + dy, x + 1 + dx]
+        return cells[crowded | ~SIMPLE[code] | (self.parent[cells] == cells)]
+
+    def labels(self):
+        #root of the patch of every shrub cell as (rows, cols) map, -1 for cells that are no shrub
+        return np.where(self.shrub, self.parent.reshape(self.shrub.shape), -1)
+
+    def sizes(self):
+        #number of cells of every patch
+        sizes = np.bincount(self.parent[self.shrub.ravel()])
+        return sizes[sizes > 0]
+
+    def count(self):
+        return len(self.sizes())
+
+    def largest(self):
+        sizes = self.sizes()
+        return int(sizes.max()) if len(sizes) else 0
+
+    def histogram(self):
+        return sizeHistogram(self.sizes())
+
+
+def sizeHistogram(sizes):
+    #number of patches per size class 1, 2-3, 4-7, 8-15, ... (class k holds sizes 2**k to 2**(k+1) - 1)
+    if not len(sizes):
+        return np.zeros(0, dtype=np.int64)
+    return np.bincount(np.log2(sizes).astype(np.int64))
+
+
+class PatchRecorder:
+    # reporter for ShrubEngine.run() that follows the shrub patches of every run and records their number, the size
+    # of the largest patch and the size histogram (see ShrubPatches.histogram()) at the start of every timestep,
+    # in statistics[cell] as a list of (timestep, count, largest, histogram). Batched runs need cells, since runs
+    # are told apart by their cell, a cell that gets a second map for a timestep it already has raises a ValueError
+    def __init__(self):
+        self.patches = {}
+        self.statistics = {}
+
+    def wants(self, timestep, nrOfTimeSteps, cell=None, final=False):
+        return True
+
+    def report(self, biotop, timestep, cell=None):
+        if cell not in self.patches:
+            self.patches[cell] = ShrubPatches(biotop)
+            self.statistics[cell] = []
+        elif timestep <= self.statistics[cell][-1][0]:
+            raise ValueError("cell %r already has a map for timestep %d, batched runs need cells to tell their "
+                             "scenarios apart" % (cell, self.statistics[cell][-1][0]))
+        else:
+            self.patches[cell].update(biotop)
+        sizes = self.patches[cell].sizes()
+        largest = int(sizes.max()) if len(sizes) else 0
+        self.statistics[cell].append((timestep, len(sizes), largest, sizeHistogram(sizes)))
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
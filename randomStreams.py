@@ -0,0 +1,65 @@
+import numpy as np
+
+# random fields of the model come from counter-based Philox streams instead of one generator that is advanced
+# step by step: the field of a scenario for a (timestep, purpose) is the stream with the 128 bit key of the
+# scenario, started at counter (0, 0, timestep, purpose). Any field can be drawn again directly, without the
+# fields before it, and it is the same whether the scenario runs alone, in a batch or in a worker process
+TRANSITION = 0    # the uniform field r shared by all transitions of a step
+REMOVAL = 1       # the uniform field of a mechanical removal event
+BACKGROUND = 2    # the bulk grass growth on empty background cells of sparseEngine.SparseShrubEngine
+
+# uniformCells() draws cells up to SPAN apart in one go, and starting a draw costs about as much as SPAN_COST
+# values of a field
+SPAN = 256
+SPAN_COST = 4000
+
+
+def streamKey(seed=None):
+    #Philox key of a scenario from an int, a SeedSequence or None (fresh entropy)
+    if not isinstance(seed, np.random.SeedSequence):
+        seed = np.random.SeedSequence(seed)
+    return seed.generate_state(2, np.uint64)
+
+
+def streamKeys(seeds):
+    return np.array([streamKey(seed) for seed in seeds], dtype=np.uint64).reshape(-1, 2)
+
+
+def generator(key, timestep, purpose):
+    #generator of stream (key, timestep, purpose), the lowest counter word counts the blocks drawn from it,
+    #so the draws of different timesteps or purposes never overlap
+    return np.random.Generator(np.random.Philox(key=key, counter=[0, 0, timestep, purpose]))
+
+
+def uniform(key, timestep, purpose, out):
+    #fills out with the float32 uniforms in [0, 1) of stream (key, timestep, purpose)
+    return generator(key, timestep, purpose).random(out=out, dtype=np.float32)
+
+
+def uniformAt(key, timestep, purpose, offset, out):
+    #fills out with the uniforms number offset, offset + 1, ... of stream (key, timestep, purpose), the same values
+    #uniform() puts there in a field of more cells, e.g. a part of a row of a map (offset = row * columns + column).
+    #Every block of the counter gives 8 float32, so the stream is advanced by whole blocks and the rest is skipped
+    bitGenerator = np.random.Philox(key=key, counter=[0, 0, timestep, purpose])
+    bitGenerator.advance(offset // 8)
+    draws = np.random.Generator(bitGenerator)
+    draws.random(offset % 8, dtype=np.float32)
+    return draws.random(out=out, dtype=np.float32)
+
+
+def uniformCells(key, timestep, purpose, cells, size):
+    #the uniforms at the sorted flat indices cells of the field of size values of stream (key, timestep, purpose),
+    #the values uniform() puts there. Cells less than SPAN apart are drawn together with uniformAt(), so a patch
+    #costs a draw per row it covers instead of a field of the whole map. Cells scattered over the map in so many
+    #spans that drawing them one by one costs more are picked from the whole field
+    breaks = np.flatnonzero(np.diff(cells) > SPAN) + 1
+    if (len(breaks) + 1) * SPAN_COST >= size:
+        return uniform(key, timestep, purpose, np.empty(size, dtype=np.float32))[cells]
+    values = np.empty(len(cells), dtype=np.float32)
+    for start, stop in zip([0, *breaks], [*breaks, len(cells)]):
+        if start == stop:
+            continue
+        first = int(cells[start])
+        span = uniformAt(key, timestep, purpose, first, np.empty(int(cells[stop - 1]) - first + 1, dtype=np.float32))
+        values[start:stop] = span[cells[start:stop] - first]
+    return values
@@ -0,0 +1,106 @@
+import numpy as np
+
+from patches import cellPatches
+from randomStreams import REMOVAL, generator, uniformCells
+
+# mechanical removal strategies of ShrubEngine, looked up by name in strategies. A strategy is called at every
+# removal event of a scenario as strategy(shrubs, f, stream, timestep) with the ShrubCells that were shrubs at the
+# start of the step, the fraction f of the scenario and the key of its random stream, whose REMOVAL field of the
+# timestep the strategy draws from (see randomStreams.py). It returns the flat indices of the cells to clear
+#
+# strategies only work on the list of shrub cells and only the removed cells are written back to the map, so an
+# event costs in the number of shrubs, not in the size of the map. Engines that step the whole map list the shrubs
+# from the shrub mask of the step (a pass at the speed of the step's own passes, only at removal events), the
+# sparse engine has them from its index of vegetated cells
+#
+# more strategies can be added to strategies before the engine is created, e.g. in a sweep script
+
+
+class ShrubCells:
+    # the cells that were shrubs at the start of a removal step: cells holds their sorted flat indices in a map
+    # of shape (rows, cols)
+    def __init__(self, cells, shape):
+        self.cells = cells
+        self.shape = shape
+
+    @classmethod
+    def fromMask(cls, shrub):
+        return cls(np.flatnonzero(shrub), shrub.shape)
+
+    def size(self):
+        return self.shape[0] * self.shape[1]
+
+    def contains(self, cells):
+        #which of the flat indices cells are shrubs
+        if not len(self.cells):
+            return np.zeros(len(cells), dtype=bool)
+        found = np.minimum(np.searchsorted(self.cells, cells), len(self.cells) - 1)
+        return self.cells[found] == cells
+
+
+def target(count, f):
+    #number of the count shrub cells a removal of fraction f takes, rounded to the nearest cell
+    return min(int(round(f * count)), count)
+
+
+def bernoulli(shrubs, f, stream, timestep):
+    #every shrub is removed with probability f independently of all others, like pcrand(uniform(1) < f, shrub) in
+    #ShrubManage.dynamic(), the number of removed cells varies from event to event. Every shrub gets its value of
+    #the field of the whole map, without drawing the field of the cells that are no shrubs
+    random = uniformCells(stream, timestep, REMOVAL, shrubs.cells, shrubs.size())
+    return shrubs.cells[random < np.float32(f)]
+
+
+def exact(shrubs, f, stream, timestep):
+    #exactly fraction f of the shrub cells, sampled without replacement
+    events = generator(stream, timestep, REMOVAL)
+    return events.choice(shrubs.cells, target(len(shrubs.cells), f), replace=False)
+
+
+def patchRemoval(shrubs, f, stream, timestep, largest):
+    #whole patches in the order of their size (ties in random order) until at least fraction f of the shrub cells
+    #is removed, the last patch is taken completely
+    cells = shrubs.cells
+    count = target(len(cells), f)
+    if not count:
+        return cells[:0]
+    root = cellPatches(cells, shrubs.shape[1])
+    roots, sizes = np.unique(root, return_counts=True)
+    events = generator(stream, timestep, REMOVAL)
+    order = events.permutation(len(roots))
+    order = order[np.argsort(-sizes[order] if largest else sizes[order], kind='stable')]
+    taken = np.searchsorted(np.cumsum(sizes[order]), count) + 1
+    chosen = np.zeros(len(cells), dtype=bool)
+    chosen[roots[order[:taken]]] = True
+    return cells[chosen[root]]
+
+
+def smallestPatches(shrubs, f, stream, timestep):
+    return patchRemoval(shrubs, f, stream, timestep, largest=False)
+
+
+def largestPatches(shrubs, f, stream, timestep):
+    return patchRemoval(shrubs, f, stream, timestep, largest=True)
+
+
+def edges(shrubs, f, stream, timestep):
+    #fraction f of the shrub cells, sampled without replacement from the edges of the patches (shrubs with a von
+    #Neumann neighbour in the map that is no shrub), a removal larger than the edge takes the whole edge
+    rows, cols = shrubs.shape
+    cells = shrubs.cells
+    y, x = np.divmod(cells, cols)
+    edge = np.zeros(len(cells), dtype=bool)
+    for inside, offset in ((y > 0, -cols), (y < rows - 1, cols), (x > 0, -1), (x < cols - 1, 1)):
+        edge[inside] |= ~shrubs.contains(cells[inside] + offset)
+    edge = cells[edge]
+    count = min(target(len(cells), f), len(edge))
+    return generator(stream, timestep, REMOVAL).choice(edge, count, replace=False)
+
+
+strategies = {
+    'bernoulli': bernoulli,
+    'exact': exact,
+    'smallestPatches': smallestPatches,
+    'largestPatches': largestPatches,
+    'edges': edges,
+}
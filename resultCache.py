@@ -0,0 +1,85 @@
+import hashlib
+import sqlite3
+
+import numpy as np
+
+from shrubEngine import MODEL_VERSION
+
+# slopes of finished runs in a local SQLite file, keyed by everything that decides the result of a run:
+#   h, n, f          parameters of the cell, rounded by parameterKey()
+#   timesteps        number of timesteps of the run
+#   state            hash of the initial state, see stateHash()
+#   seed             seed of the sweep, the stream of a cell is derived from it and from h
+#   tolerance        steady state tolerance of ShrubEngine.run(), -1 for runs without steady state check
+#   window           window of the steady state check
+#   version          MODEL_VERSION of the engine the result was computed with
+#   removal          name of the mechanical removal strategy, see removal.py
+# every sweep adds the slopes of its cells as soon as a row is finished, so an interrupted sweep only reruns
+# the rows that were not done and overlapping sweeps reuse the cells they share
+SCHEMA = '''CREATE TABLE IF NOT EXISTS results (
+    h REAL, n REAL, f REAL, timesteps INTEGER, state TEXT, seed INTEGER, tolerance REAL, window INTEGER,
+    version INTEGER, removal TEXT, slope REAL,
+    PRIMARY KEY (h, n, f, timesteps, state, seed, tolerance, window, version, removal))'''
+
+
+def parameterKey(parameters):
+    #(h, n, f) rounded to 12 digits, so a cell gets the same key whether its value came from np.mgrid, np.arange
+    #or a literal (0.1 + 9 * 0.1 is not 1.0)
+    return tuple(round(float(value), 12) for value in parameters)
+
+
+def stateHash(initialState):
+    initialState = np.ascontiguousarray(initialState, dtype=np.uint8)
+    digest = hashlib.sha1(str(initialState.shape).encode())
+    digest.update(initialState.tobytes())
+    return digest.hexdigest()
+
+
+class ResultCache:
+    # lookups and inserts of one sweep, all cells share timesteps, initial state, seed and the steady state options
+    def __init__(self, path, nrOfTimeSteps, initialState, seed, tolerance=None, window=5, removal='bernoulli'):
+        if seed is None:
+            raise ValueError("a result cache needs a fixed seed, runs without one are not reproducible")
+        self.path = path
+        self.context = (int(nrOfTimeSteps), stateHash(initialState), int(seed),
+                        -1.0 if tolerance is None else float(tolerance), int(window), MODEL_VERSION, removal)
+        self.connection = sqlite3.connect(path)
+        self.upgrade()
+        self.connection.execute(SCHEMA)
+
+    def upgrade(self):
+        #caches written before removal strategies were added hold only results of the 'bernoulli' removal
+        columns = [row[1] for row in self.connection.execute('PRAGMA table_info(results)')]
+        if columns and 'removal' not in columns:
+            with self.connection:
+                self.connection.execute('ALTER TABLE results RENAME TO oldResults')
+                self.connection.execute(SCHEMA)
+                self.connection.execute(
+                    "INSERT INTO results SELECT h, n, f, timesteps, state, seed, tolerance, window, version, "
+                    "'bernoulli', slope FROM oldResults")
+                self.connection.execute('DROP TABLE oldResults')
+
+    def get(self, parameters):
+        #slope of the cell with parameters (h, n, f), None if it was not run yet
+        row = self.connection.execute(
+            'SELECT slope FROM results WHERE h = ? AND n = ? AND f = ? AND timesteps = ? AND state = ? AND seed = ? '
+            'AND tolerance = ? AND window = ? AND version = ? AND removal = ?',
+            parameterKey(parameters) + self.context).fetchone()
+        return None if row is None else row[0]
+
+    def put(self, parameterRows, slopes):
+        #adds the slopes of a finished row of cells in one transaction
+        with self.connection:
+            self.connection.executemany(
+                'INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                [parameterKey(parameters) + self.context + (float(slope),)
+                 for parameters, slope in zip(parameterRows, slopes)])
+
+    def close(self):
+        self.connection.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
@@ -0,0 +1,626 @@
+import json
+import os
+
+import numpy as np
+
+from biotopStore import packBiotop, unpackBiotop
+from bitplanes import unpackBitplanes
+from instrumentation import nullProfiler
+from randomStreams import TRANSITION, streamKeys, uniform
+from removal import ShrubCells, strategies
+
+#2=shrubs, 1=grass, 0=empty
+EMPTY = 0
+GRASS = 1
+SHRUB = 2
+
+# model parameters as set in ShrubManage.initial()
+defaultParameters = {
+    'b1': 6.8,
+    'b2': 0.387,
+    'b3': 38.8,
+    's1': 0.109,
+    's2': 0.061,
+    'bg': 0.5,
+    'c': 0.0015,
+    'ds': 0.028,
+    'dg': 0.125,
+    'theta': 0.8,
+}
+
+# version of the model dynamics and of its random streams, raised whenever a change gives different results for the
+# same parameters and seed, so results cached by resultCache.ResultCache are not reused across such changes
+MODEL_VERSION = 3
+
+# reasons for ending a run before its last timestep, see ShrubEngine.run()
+EXTINCT = 'extinct'    # no shrubs left, shrubs can only grow next to shrubs so this is absorbing
+BARE = 'bare'          # no shrubs and no grass left, nothing can grow anymore
+STEADY = 'steady'      # shrub density changed less than the tolerance over the window
+
+# every cell contributes 5 to its neighbours' code if it is a shrub and 1 if it is grass, so a single
+# von Neumann sum gives code = 5 * shrub neighbours + grass neighbours (both 0 to 4)
+neighbourWeight = np.array([0, 1, 5], dtype=np.uint8)
+#used von Neumann neighbourhood for all functions (as defined on p.162, 2.2), q = neighbour count / 4
+neighbourFraction = np.arange(5, dtype=np.float32) * np.float32(0.25)
+
+
+def window4total(values, out):
+    #same as pcraster window4total: sum of the 4 von Neumann neighbours, cells outside the map count as 0
+    out.fill(0)
+    np.add(out[..., 1:, :], values[..., :-1, :], out=out[..., 1:, :])
+    np.add(out[..., :-1, :], values[..., 1:, :], out=out[..., :-1, :])
+    np.add(out[..., :, 1:], values[..., :, :-1], out=out[..., :, 1:])
+    np.add(out[..., :, :-1], values[..., :, 1:], out=out[..., :, :-1])
+    return out
+
+
+class Neighbourhood:
+    # von Neumann neighbourhood of one step: the packed neighbour code (5 * shrub neighbours + grass neighbours)
+    # of every cell from a single pass over the state, and the grass fraction pg of every scenario
+    def __init__(self, state, pg, weight, code):
+        np.take(neighbourWeight, state, out=weight, mode='clip')
+        window4total(weight, code)
+        self.code = code
+        self.pg = pg
+
+
+class GrassFraction:
+    # the part of the neighbourhood transitionTables() needs, the grass fraction pg of every scenario, for engines
+    # that look up the neighbour codes of their cells themselves (see sparseEngine.py and tiledEngine.py)
+    def __init__(self, pg):
+        self.pg = pg
+
+
+#the transition functions of ShrubManage, evaluated for the 5 possible neighbour counts (0 to 4),
+#with one row per scenario where grazing pressure h or grass fraction pg differ between scenarios
+def empty2grass(model, neighbourhood):
+    #weg = bg * qge + theta * pg, indexed by the grass neighbour count
+    return neighbourFraction * model.bg + (model.theta * neighbourhood.pg).astype(np.float32).reshape(-1, 1)
+
+
+def grass2empty(model, neighbourhood):
+    return np.float32(model.dg)
+
+
+def empty2shrub(model, neighbourhood):
+    #wes = ((1 - qse) * b1 + s1) * qse, indexed by the shrub neighbour count
+    return ((1 - neighbourFraction) * model.b1 + model.s1) * neighbourFraction
+
+
+def grass2shrub(model, neighbourhood):
+    # including grazing pressure h (last sentence in 2.7), wgs = ((1 - qsg) * b2 * (1 - h) + s2) * qsg
+    return ((1 - neighbourFraction) * model.b2h.reshape(-1, 1) + model.s2) * neighbourFraction
+
+
+def shrub2empty(model, neighbourhood):
+    #wse = ds + c * qss
+    return neighbourFraction * model.c + model.ds
+
+
+# all transitions of a step depend only on the state of a cell, its neighbour code and one random number r, so
+# a step is three lookups in tables indexed by key = state * 25 + neighbour code (75 keys per scenario):
+#   a = r < first[key]                    grass growth (empty), grass death (grass) or shrub death (shrub)
+#   b = r < second[2 * key + a]           shrub growth on the cell as it is after the grass update
+#   new state = outcome[4 * key + 2 * a + b]
+# which is the same sequence of ifthenelse decisions as ShrubManage.dynamic(), all with the same r
+KEYS = 75
+outcomeTable = np.empty((3, 25, 2, 2), dtype=np.uint8)
+outcomeTable[EMPTY] = [[EMPTY, SHRUB], [GRASS, SHRUB]]
+outcomeTable[GRASS] = [[GRASS, SHRUB], [EMPTY, SHRUB]]
+outcomeTable[SHRUB] = [[SHRUB, SHRUB], [EMPTY, EMPTY]]
+outcomeTable = outcomeTable.reshape(-1)
+# (state before, state after) of the transitions counted by transitionCounts()
+transitionStates = {
+    'empty2grass': (EMPTY, GRASS),
+    'grass2empty': (GRASS, EMPTY),
+    'empty2shrub': (EMPTY, SHRUB),
+    'grass2shrub': (GRASS, SHRUB),
+    'shrub2empty': (SHRUB, EMPTY),
+}
+
+
+def outcomeCounts(key, nrOfScenarios):
+    #number of cells of every scenario by state before the step and the two draws (scenarios, 3, 4), from one
+    #bincount of its outcome keys 4 * key + 2 * a + b (see outcomeTable). The outcome of a key does not depend on
+    #the neighbour code, so the codes are summed out
+    cells = np.bincount(key.reshape(-1), minlength=4 * KEYS * nrOfScenarios)
+    return cells.reshape(nrOfScenarios, 3, 25, 4).sum(axis=2)
+
+
+def transitionCounts(key, nrOfScenarios, cells=None):
+    #number of cells of every transition of a step, summed over the scenarios, from its outcome keys or from their
+    #outcomeCounts() cells
+    if cells is None:
+        cells = outcomeCounts(key, nrOfScenarios)
+    cells = cells.sum(axis=0)
+    after = outcomeTable.reshape(3, 25, 4)[:, 0]
+    return {name: int(cells[before][after[before] == state].sum())
+            for name, (before, state) in transitionStates.items()}
+
+
+def stateCounts(cells):
+    #number of empty, grass and shrub cells of every scenario after the step (scenarios, 3), from the outcomeCounts()
+    #cells of the step
+    after = outcomeTable.reshape(3, 25, 4)[:, 0]
+    return np.stack([cells[:, after == state].sum(axis=1) for state in (EMPTY, GRASS, SHRUB)], axis=1)
+
+
+def transitionTables(model, neighbourhood):
+    #first (scenarios, 75) and second (scenarios, 150) thresholds of every key, rebuilt every step since pg changes
+    nrOfScenarios = len(neighbourhood.pg)
+    weg = np.broadcast_to(empty2grass(model, neighbourhood), (nrOfScenarios, 5))
+    wes = np.broadcast_to(empty2shrub(model, neighbourhood), (nrOfScenarios, 5))
+    wgs = np.broadcast_to(grass2shrub(model, neighbourhood), (nrOfScenarios, 5))
+    wse = np.broadcast_to(shrub2empty(model, neighbourhood), (nrOfScenarios, 5))
+    first = np.empty((nrOfScenarios, 3, 5, 5), dtype=np.float32)
+    first[:, EMPTY] = weg[:, None, :]
+    first[:, GRASS] = grass2empty(model, neighbourhood)
+    first[:, SHRUB] = wse[:, :, None]
+    second = np.zeros((nrOfScenarios, 3, 5, 5, 2), dtype=np.float32)
+    second[:, EMPTY, :, :, 0] = wes[:, :, None]
+    second[:, EMPTY, :, :, 1] = wgs[:, :, None]
+    second[:, GRASS, :, :, 0] = wgs[:, :, None]
+    second[:, GRASS, :, :, 1] = wes[:, :, None]
+    return first.reshape(-1), second.reshape(-1)
+
+
+def unpackState(encoding, state, shape):
+    #(scenarios, y, x) maps of the state of a checkpoint, see ShrubEngine.packedState()
+    if encoding == 'bitplanes':
+        return unpackBitplanes(state[0], state[1], shape[2])
+    return unpackBiotop(state, (shape[0] * shape[1], shape[2])).reshape(shape)
+
+
+class ShrubEngine:
+    # NumPy version of ShrubManage.dynamic(), the state is advanced in place and all maps needed
+    # during a step are allocated once in the constructor and reused by every reset()/step()
+    #
+    # biotop is either one map (y, x) or a stack of N scenarios (N, y, x) that are stepped together,
+    # h, n, f and seed then are per-scenario vectors (scalars are broadcast to all scenarios)
+    #
+    # removal is the name of the mechanical removal strategy in removal.strategies, 'bernoulli' removes every shrub
+    # with probability f like ShrubManage.dynamic()
+    #
+    # profiler, an instrumentation.Profiler, times the phases of every step and run() and counts the transitions,
+    # forks and branches of the engine share it
+    #
+    # engines that keep their maps in other buffers (see packedEngine.py) name them in stateBuffers
+    stateBuffers = ('state',)
+
+    def __init__(self, biotop, h=0.0, n=0, f=0.0, seed=None, removal='bernoulli', profiler=None, **parameters):
+        if removal not in strategies:
+            raise ValueError("unknown removal strategy %r, expected one of %s" % (removal, ", ".join(strategies)))
+        self.removal = removal
+        self.profiler = nullProfiler if profiler is None else profiler
+        for name, value in defaultParameters.items():
+            setattr(self, name, parameters.pop(name, value))
+        if parameters:
+            raise TypeError("unknown model parameters: %s" % ", ".join(sorted(parameters)))
+
+        shape = np.shape(biotop)
+        if len(shape) not in (2, 3):
+            raise ValueError("biotop must be a (y, x) map or a (scenario, y, x) stack, got shape %s" % (shape,))
+        self.batched = len(shape) == 3
+        if not self.batched:
+            shape = (1,) + shape
+        self.nrOfScenarios = shape[0]
+        self.mapShape = shape[1:]
+        #the maps are views on these buffers, narrowed to the scenarios still running (see compact())
+        self.buffers = self.allocate(shape)
+        self.useScenarios(self.nrOfScenarios)
+        self.reset(biotop, h, n, f, seed)
+
+    @property
+    def biotop(self):
+        #the maps of all scenarios of a batched engine, the map of a single map engine, which is kept when its run
+        #ends early
+        return self.buffers['state'] if self.batched else self.buffers['state'][0]
+
+    def allocate(self, shape):
+        return {
+            'state': np.empty(shape, dtype=np.uint8),
+            'random': np.empty(shape, dtype=np.float32),
+            'threshold': np.empty(shape, dtype=np.float32),
+            'weight': np.empty(shape, dtype=np.uint8),
+            'code': np.empty(shape, dtype=np.uint8),
+            #table keys are kept as indices, so the lookups need no conversion
+            'key': np.empty(shape, dtype=np.intp),
+            'shrub': np.empty(shape, dtype=bool),
+            'change': np.empty(shape, dtype=bool),
+        }
+
+    def useScenarios(self, count):
+        for name, buffer in self.buffers.items():
+            setattr(self, name, buffer[:count])
+
+    def loadMaps(self, maps):
+        #makes the (scenarios, y, x) maps the state of the first scenarios and runs only those
+        self.buffers['state'][:len(maps)] = maps
+        self.useScenarios(len(maps))
+
+    def scenarioMap(self, position):
+        #(y, x) map of the running scenario at position
+        return self.state[position]
+
+    def reset(self, biotop, h, n, f, seed=None):
+        nrOfScenarios = self.nrOfScenarios
+        self.useScenarios(nrOfScenarios)
+        #position of every running scenario in the original stack
+        self.scenario = np.arange(nrOfScenarios)
+        self.terminationReason = [None] * nrOfScenarios
+        self.terminatedAt = np.full(nrOfScenarios, -1)
+        #initializing parameters for management practices, one entry per scenario
+        self.h = np.broadcast_to(np.asarray(h, dtype=np.float64), (nrOfScenarios,)).copy()    # grazing pressure (0 to 1)
+        self.n = np.broadcast_to(np.asarray(n, dtype=np.float64), (nrOfScenarios,)).copy()    # removal event period (in years)
+        self.f = np.broadcast_to(np.asarray(f, dtype=np.float64), (nrOfScenarios,)).copy()    # fraction of shrub area removed
+        self.year = np.zeros(nrOfScenarios, dtype=np.int64)
+        self.timestep = 0
+        #grazing only enters grass2shrub, so b2 * (1 - h) is computed once per run
+        self.b2h = (self.b2 * (1 - self.h)).astype(np.float32).reshape(-1, 1, 1)
+        #shrub density of every scenario at the start of every timestep run so far, see run()
+        self.densities = None
+        if self.batched and (seed is None or np.ndim(seed) == 0):
+            seed = np.random.SeedSequence(seed).spawn(nrOfScenarios)
+        #Philox key of every scenario, the random fields of a step are drawn from it by timestep (see randomStreams.py)
+        self.streams = streamKeys(seed if self.batched else [seed])
+        if len(self.streams) != nrOfScenarios:
+            raise ValueError("expected %d seeds, got %d" % (nrOfScenarios, len(self.streams)))
+        #missing values (MV_UINT1) or other classes would be looked up as shrubs and count as empty cells
+        if np.max(biotop) > SHRUB:
+            raise ValueError("biotop cells must be EMPTY, GRASS or SHRUB, got %d" % np.max(biotop))
+        self.loadMaps(np.broadcast_to(biotop, (nrOfScenarios,) + self.mapShape))
+        self.countStates()
+
+    def compact(self, keep):
+        #drops the scenarios where keep is False, the remaining ones are moved to the front of the buffers
+        #so every following step only touches scenarios that are still running
+        keep = np.flatnonzero(keep)
+        for name in self.stateBuffers:
+            self.buffers[name][:len(keep)] = getattr(self, name)[keep]
+        self.useScenarios(len(keep))
+        self.scenario = self.scenario[keep]
+        self.h = self.h[keep]
+        self.n = self.n[keep]
+        self.f = self.f[keep]
+        self.year = self.year[keep]
+        self.b2h = self.b2h[keep]
+        self.counts = self.counts[keep]
+        self.streams = self.streams[keep]
+
+    def cellsPerMap(self):
+        return self.mapShape[0] * self.mapShape[1]
+
+    def countStates(self):
+        #number of empty, grass and shrub cells of every running scenario, kept in self.counts (scenario, state)
+        #until the next step. Recounted from the state after a step, two compare and count passes over the maps;
+        #a step with transition counting takes them from its bincount of the outcome keys instead (see step()),
+        #which on its own costs about twice the recount
+        np.equal(self.state, GRASS, out=self.change)
+        grass = np.count_nonzero(self.change, axis=(-2, -1))
+        np.equal(self.state, SHRUB, out=self.change)
+        shrub = np.count_nonzero(self.change, axis=(-2, -1))
+        self.counts = np.stack([self.cellsPerMap() - grass - shrub, grass, shrub], axis=1)
+
+    def stateCount(self, state):
+        if self.batched:
+            return self.counts[:, state]
+        #a single map run that ended early keeps its final biotop, but no longer its counts
+        return self.counts[0, state] if len(self.scenario) else np.count_nonzero(self.biotop == state)
+
+    def emptyCount(self):
+        return self.stateCount(EMPTY)
+
+    def grassCount(self):
+        return self.stateCount(GRASS)
+
+    def shrubCount(self):
+        return self.stateCount(SHRUB)
+
+    def shrubDensity(self):
+        return self.shrubCount() / self.cellsPerMap()
+
+    def parameters(self):
+        return {name: getattr(self, name) for name in defaultParameters}
+
+    def packedState(self):
+        #encoding and packed maps of the running scenarios for a checkpoint, see unpackState()
+        return '2bit', packBiotop(self.state[:len(self.scenario)])
+
+    def saveCheckpoint(self, path):
+        #writes everything needed to continue the run to a compressed .npz file: the packed maps of the
+        #running scenarios, their year counters and random stream keys, the densities recorded so far
+        #and the parameters. The file is written under a temporary name first, so a crash never leaves half a
+        #checkpoint behind
+        encoding, state = self.packedState()
+        densities = np.empty((self.nrOfScenarios, 0)) if self.densities is None else self.densities[:, :self.recorded()]
+        temporary = "%s.%d.tmp" % (path, os.getpid())
+        with open(temporary, 'wb') as checkpointFile:
+            np.savez_compressed(
+                checkpointFile,
+                version=MODEL_VERSION,
+                shape=np.array((self.nrOfScenarios,) + self.mapShape),
+                batched=self.batched,
+                encoding=encoding,
+                state=state,
+                scenario=self.scenario,
+                h=self.h, n=self.n, f=self.f,
+                year=self.year,
+                timestep=self.timestep,
+                terminationReason=json.dumps(self.terminationReason),
+                terminatedAt=self.terminatedAt,
+                densities=densities,
+                streams=self.streams,
+                removal=self.removal,
+                parameters=json.dumps(self.parameters()))
+        os.replace(temporary, path)
+
+    @classmethod
+    def restore(cls, path):
+        #engine in the state saved by saveCheckpoint(), run() continues at the saved timestep
+        with np.load(path) as checkpoint:
+            if int(checkpoint['version']) != MODEL_VERSION:
+                raise ValueError("%s was written by model version %d, this is version %d"
+                                 % (path, int(checkpoint['version']), MODEL_VERSION))
+            shape = tuple(int(size) for size in checkpoint['shape'])
+            scenario = checkpoint['scenario']
+            #checkpoints written before the removal strategies all used bernoulli removal
+            removal = str(checkpoint['removal']) if 'removal' in checkpoint else 'bernoulli'
+            engine = cls(np.zeros(shape if checkpoint['batched'] else shape[1:], dtype=np.uint8),
+                         removal=removal, **json.loads(str(checkpoint['parameters'])))
+            encoding = str(checkpoint['encoding']) if 'encoding' in checkpoint else '2bit'
+            engine.loadMaps(unpackState(encoding, checkpoint['state'], (len(scenario),) + shape[1:]))
+            engine.countStates()
+            engine.scenario = scenario
+            engine.h, engine.n, engine.f = checkpoint['h'], checkpoint['n'], checkpoint['f']
+            engine.b2h = (engine.b2 * (1 - engine.h)).astype(np.float32).reshape(-1, 1, 1)
+            engine.year = checkpoint['year']
+            engine.timestep = int(checkpoint['timestep'])
+            engine.terminationReason = json.loads(str(checkpoint['terminationReason']))
+            engine.terminatedAt = checkpoint['terminatedAt']
+            engine.densities = checkpoint['densities']
+            engine.streams = checkpoint['streams']
+        return engine
+
+    def recorded(self):
+        #number of timesteps with a recorded density, a run that ended early recorded the timestep it ended at
+        return max(self.timestep, int(self.terminatedAt.max()))
+
+    def fork(self, h, n, f, seeds, position=0):
+        #batched engine whose scenarios all start from the current biotop of scenario position (e.g. after a
+        #burn-in run), with their own management parameters and seeds and with year and timestep back at 0
+        h, n, f = np.broadcast_arrays(np.atleast_1d(h), np.atleast_1d(n), np.atleast_1d(f))
+        stack = np.broadcast_to(self.scenarioMap(position), (len(h),) + self.mapShape)
+        return type(self)(stack, h, n, f, seeds, self.removal, profiler=self.profiler, **self.parameters())
+
+    def branch(self, h, n, f, position=0):
+        #batched engine continuing the run of scenario position with other management parameters: every
+        #scenario starts with a copy of its biotop, year, timestep, random stream and recorded densities,
+        #so until its first removal event it repeats exactly what the scenario would have done
+        engine = self.fork(h, n, f, None, position)
+        engine.year[:] = self.year[position]
+        engine.timestep = self.timestep
+        engine.densities = np.repeat(self.densities[self.scenario[position]:self.scenario[position] + 1,
+                                                    :self.recorded()], engine.nrOfScenarios, axis=0)
+        engine.streams = np.repeat(self.streams[position:position + 1], engine.nrOfScenarios, axis=0)
+        return engine
+
+    def step(self):
+        profiler = self.profiler
+        profiler.start()
+        biotop = self.state
+        random = self.random
+        threshold = self.threshold
+        key = self.key
+        change = self.change
+        for stream, scenarioRandom in zip(self.streams, random):
+            uniform(stream, self.timestep, TRANSITION, scenarioRandom)
+        profiler.lap('random')
+        pg = self.counts[:, GRASS] / self.cellsPerMap()
+        neighbourhood = Neighbourhood(biotop, pg, self.weight, self.code)
+        first, second = transitionTables(self, neighbourhood)
+        outcome = np.tile(outcomeTable, len(pg))
+        profiler.lap('neighbourhood')
+
+        #key = state * 25 + neighbour code, offset by 75 keys for every scenario before it
+        np.multiply(biotop, 25, out=key)
+        np.add(key, self.code, out=key)
+        np.add(key, (np.arange(len(pg)) * KEYS).reshape(-1, 1, 1), out=key)
+        np.take(first, key, out=threshold, mode='clip')
+        np.less(random, threshold, out=change)
+        profiler.lap('grass')
+        np.multiply(key, 2, out=key)
+        np.add(key, change, out=key)
+        np.take(second, key, out=threshold, mode='clip')
+        np.less(random, threshold, out=change)
+        np.multiply(key, 2, out=key)
+        np.add(key, change, out=key)
+        profiler.lap('shrub')
+
+        #mechanical removal event every nth year with fraction f being removed by the removal strategy,
+        #only cells that were shrubs before this step's shrub update can be removed, so the shrubs of the
+        #scenarios with an event are listed before the new states are written
+        self.year = self.year + 1
+        removing = np.flatnonzero(self.year == self.n)
+        shrubs = [ShrubCells.fromMask(np.equal(biotop[scenario], SHRUB, out=self.shrub[scenario]))
+                  for scenario in removing]
+        profiler.lap('removal')
+        np.take(outcome, key, out=biotop, mode='clip')
+        profiler.lap('shrub')
+        #with transition counting, the bincount of the outcome keys it takes anyway also gives the new counts,
+        #removal events then move their cleared shrubs to the empty cells and the recount is left out
+        counted = profiler.countTransitions
+        if counted:
+            outcomes = outcomeCounts(key, len(pg))
+            profiler.count(transitionCounts(key, len(pg), outcomes))
+            self.counts = stateCounts(outcomes)
+            profiler.lap('counting')
+
+        remove = strategies[self.removal]
+        for scenario, scenarioShrubs in zip(removing, shrubs):
+            cells = remove(scenarioShrubs, self.f[scenario], self.streams[scenario], self.timestep)
+            if counted:
+                #the cells were shrubs at the start of the step, so the ones that are not empty now are shrubs
+                removed = np.count_nonzero(biotop[scenario].reshape(-1)[cells])
+                profiler.count({'removed': removed})
+                self.counts[scenario] += (removed, 0, -removed)
+            biotop[scenario].reshape(-1)[cells] = EMPTY
+            self.year[scenario] = 0
+        profiler.lap('removal')
+        self.timestep = self.timestep + 1
+        if not counted:
+            self.countStates()
+        profiler.lap('density')
+        profiler.endStep(self)
+
+    def run(self, nrOfTimeSteps, tolerance=None, window=5, reporter=None, cells=None, checkpoint=None, every=10):
+        #shrub density is recorded at the start of every timestep, like in ShrubManage.dynamic(),
+        #a batched engine returns one shrubDensity list per scenario
+        #
+        #runs end early once shrubs are extinct (or everything is bare) and, if tolerance is given, once the shrub
+        #density changed less than tolerance over the last window timesteps. The remaining timesteps get the last
+        #density, terminationReason and terminatedAt tell which scenarios stopped why and when. Afterwards only the
+        #scenarios that ran to the end are left in state, a single map run keeps its final biotop in either case
+        #
+        #reporter (a mapReport.BufferedMapWriter) gets the biotop at the start of every timestep it wants, cells
+        #names the parameter cell of every scenario for the report policy
+        #
+        #with a checkpoint path, the engine is saved there every few timesteps (see saveCheckpoint()), an engine
+        #from restore() continues the run at the timestep it was saved at
+        if cells is None:
+            cells = [None] * self.nrOfScenarios
+        densities = np.empty((self.nrOfScenarios, nrOfTimeSteps))
+        if self.densities is not None:
+            densities[:, :self.recorded()] = self.densities[:, :self.recorded()]
+            for scenario in np.flatnonzero(self.terminatedAt > 0):
+                densities[scenario, self.terminatedAt[scenario]:] = densities[scenario, self.terminatedAt[scenario] - 1]
+        self.densities = densities
+        profiler = self.profiler
+        profiler.startRun(self, nrOfTimeSteps)
+        try:
+            start = self.timestep
+            for timestep in range(start, nrOfTimeSteps):
+                if not len(self.scenario):
+                    break
+                profiler.start()
+                if checkpoint is not None and timestep % every == 0 and timestep > start:
+                    self.saveCheckpoint(checkpoint)
+                    profiler.lap('checkpoint')
+                density = self.counts[:, SHRUB] / self.cellsPerMap()
+                densities[self.scenario, timestep] = density
+                done = density == 0
+                if tolerance is not None and timestep >= window:
+                    done |= np.abs(density - densities[self.scenario, timestep - window]) < tolerance
+                profiler.lap('density')
+                if reporter is not None:
+                    for position, scenario in enumerate(self.scenario):
+                        if reporter.wants(timestep + 1, nrOfTimeSteps, cells[scenario], final=done[position]):
+                            reporter.report(self.scenarioMap(position), timestep + 1, cells[scenario])
+                    profiler.lap('report')
+                if done.any():
+                    for position in np.flatnonzero(done):
+                        scenario = self.scenario[position]
+                        if density[position] > 0:
+                            self.terminationReason[scenario] = STEADY
+                        elif self.counts[position, GRASS]:
+                            self.terminationReason[scenario] = EXTINCT
+                        else:
+                            self.terminationReason[scenario] = BARE
+                        self.terminatedAt[scenario] = timestep + 1
+                        densities[scenario, timestep + 1:] = density[position]
+                    self.compact(~done)
+                    profiler.lap('compact')
+                    if not len(self.scenario):
+                        break
+                self.step()
+            profiler.endRun(self)
+        finally:
+            profiler.close()
+        shrubDensity = [[[density, timestep] for timestep, density in enumerate(row, start=1)] for row in densities]
+        return shrubDensity if self.batched else shrubDensity[0]
+
+
+def runBatch(initialState, parameters, nrOfTimeSteps, seeds=None, batchSize=100, tolerance=None, window=5,
+             reasons=None, reporter=None, cells=None, out=None, removal='bernoulli', profiler=None):
+    #runs every (h, n, f) row of parameters, batchSize scenarios at a time stacked in one engine,
+    #and returns the shrubDensity list of every run in the order of parameters, the termination reason of every
+    #run (None if it ran all timesteps) is appended to reasons if a list is given. reporter and cells (one per
+    #row of parameters) are passed on to ShrubEngine.run(). With out, a (runs, timesteps) array, the densities
+    #of every run are also written to the row of out with the number of the run. removal is the removal strategy
+    #of all runs and profiler an instrumentation.Profiler for all of their steps, see ShrubEngine
+    parameters = np.reshape(parameters, (-1, 3))
+    if seeds is None or np.ndim(seeds) == 0:
+        seeds = np.random.SeedSequence(seeds).spawn(len(parameters))
+    shrubDensities = []
+    engine = None
+    for start in range(0, len(parameters), batchSize):
+        batch = parameters[start:start + batchSize]
+        stack = np.broadcast_to(initialState, (len(batch),) + np.shape(initialState))
+        if engine is None or engine.nrOfScenarios != len(batch):
+            engine = ShrubEngine(stack, batch[:, 0], batch[:, 1], batch[:, 2], seeds[start:start + batchSize], removal,
+                                 profiler)
+        else:
+            engine.reset(stack, batch[:, 0], batch[:, 1], batch[:, 2], seeds[start:start + batchSize])
+        batchCells = None if cells is None else cells[start:start + batchSize]
+        shrubDensities.extend(engine.run(nrOfTimeSteps, tolerance, window, reporter, batchCells))
+        if out is not None:
+            out[start:start + len(batch)] = engine.densities
+        if reasons is not None:
+            reasons.extend(engine.terminationReason)
+    return shrubDensities
+
+
+def firstRemoval(n, nrOfTimeSteps):
+    #step at which a run with removal period n first removes shrubs, None if that does not change any of the
+    #recorded densities (no removal for n = 0 or a period that is not a whole number of years)
+    if n >= 1 and n == int(n) and n < nrOfTimeSteps:
+        return int(n)
+    return None
+
+
+def seedKey(seed, cell):
+    #runs whose seeds give the same random stream get the same key
+    if isinstance(seed, np.random.SeedSequence):
+        return seed.entropy, seed.spawn_key
+    if seed is None or np.ndim(seed) != 0:
+        return 'cell', cell
+    return seed
+
+
+def runShared(initialState, parameters, nrOfTimeSteps, seeds, tolerance=None, window=5, reasons=None, out=None,
+              removal='bernoulli', profiler=None):
+    #same results as runBatch(), but runs with the same grazing pressure h and the same seed (common random numbers)
+    #follow identical dynamics until their first removal event, so their shared prefix is simulated only once:
+    #one trunk run without removal is advanced up to the step before the first removal of every removal period
+    #and branched there into a batch of the (n, f) runs that start removing at that step. out, removal and profiler
+    #work like in runBatch()
+    parameters = np.reshape(parameters, (-1, 3))
+    shrubDensities = [None] * len(parameters)
+    cellReasons = [None] * len(parameters)
+    groups = {}
+    for cell, (h, n, f) in enumerate(parameters):
+        groups.setdefault((h, seedKey(seeds[cell], cell)), []).append(cell)
+    for (h, key), cells in groups.items():
+        trunk = ShrubEngine(initialState, h, 0, 0.0, seeds[cells[0]], removal, profiler)
+        divergence = {cell: firstRemoval(parameters[cell, 1], nrOfTimeSteps) for cell in cells}
+        for timestep in sorted(set(divergence.values()) - {None}):
+            trunk.run(timestep - 1, tolerance, window)
+            if not len(trunk.scenario):
+                break
+            branchCells = [cell for cell in cells if divergence[cell] == timestep]
+            branch = trunk.branch(parameters[branchCells, 0], parameters[branchCells, 1], parameters[branchCells, 2])
+            for position, shrubDensity in enumerate(branch.run(nrOfTimeSteps, tolerance, window)):
+                shrubDensities[branchCells[position]] = shrubDensity
+                cellReasons[branchCells[position]] = branch.terminationReason[position]
+            if out is not None:
+                out[branchCells] = branch.densities
+        #runs without removal, and all runs that had not branched before the trunk ended early, end like the trunk
+        trunkDensity = trunk.run(nrOfTimeSteps, tolerance, window)
+        for cell in cells:
+            if shrubDensities[cell] is None:
+                shrubDensities[cell] = [list(item) for item in trunkDensity]
+                cellReasons[cell] = trunk.terminationReason[0]
+                if out is not None:
+                    out[cell] = trunk.densities[0]
+    if reasons is not None:
+        reasons.extend(cellReasons)
+    return shrubDensities
@@ -0,0 +1,167 @@
+import numpy as np
+
+from randomStreams import BACKGROUND, TRANSITION, generator
+from removal import ShrubCells, strategies
+from shrubEngine import (EMPTY, GRASS, KEYS, SHRUB, GrassFraction, ShrubEngine, neighbourWeight, outcomeTable,
+                         transitionCounts, transitionTables, window4total)
+
+
+def distinct(cells, size):
+    #sorted distinct values of cells (flat indices of a map of size cells), by sorting them or, for many cells,
+    #by marking them on the map (both much faster than np.unique)
+    if len(cells) * 8 < size:
+        cells = np.sort(cells)
+        return cells[np.concatenate([[True], cells[1:] != cells[:-1]])]
+    mask = np.zeros(size, dtype=bool)
+    mask[cells] = True
+    return np.flatnonzero(mask)
+
+
+def firstDraws(cells):
+    #cells without the repeated draws, in the order they were first drawn
+    order = np.argsort(cells, kind='stable')
+    cells = cells[order]
+    first = order[np.concatenate([[True], cells[1:] != cells[:-1]])]
+    return np.sort(first)
+
+
+def activeCells(vegetated, shape):
+    #sorted flat indices of the vegetated cells and of their von Neumann neighbours
+    rows, cols = shape
+    y, x = np.divmod(vegetated, cols)
+    return distinct(np.concatenate([vegetated, vegetated[y > 0] - cols, vegetated[y < rows - 1] + cols,
+                                    vegetated[x > 0] - 1, vegetated[x < cols - 1] + 1]), rows * cols)
+
+
+def neighbourCode(state, cells, shape):
+    #5 * shrub neighbours + grass neighbours of the cells of the flat state, cells outside the map count as empty
+    rows, cols = shape
+    y, x = np.divmod(cells, cols)
+    code = np.zeros(len(cells), dtype=np.uint8)
+    for inside, offset in ((y > 0, -cols), (y < rows - 1, cols), (x > 0, -1), (x < cols - 1, 1)):
+        code[inside] += neighbourWeight[state[cells[inside] + offset]]
+    return code
+
+
+def placeBackground(state, active, count, background, shape, events):
+    #count distinct cells drawn uniformly from the background, the empty cells without a vegetated neighbour.
+    #On a mostly empty map random cells are drawn until count of them are background cells, which needs no pass
+    #over the map, otherwise the background is listed and sampled
+    size = shape[0] * shape[1]
+    if not count:
+        return np.zeros(0, dtype=np.intp)
+    if background * 2 < size:
+        mask = state == EMPTY
+        mask[active] = False
+        return events.choice(np.flatnonzero(mask), count, replace=False)
+    chosen = np.zeros(0, dtype=np.intp)
+    while len(chosen) < count:
+        candidates = events.integers(0, size, 2 * (count - len(chosen)) + 16)
+        candidates = candidates[(state[candidates] == EMPTY) & (neighbourCode(state, candidates, shape) == 0)]
+        #a cell drawn twice counts once, at its first draw
+        candidates = np.concatenate([chosen, candidates])
+        chosen = candidates[firstDraws(candidates)[:count]]
+    return chosen
+
+
+class SparseShrubEngine(ShrubEngine):
+    # ShrubEngine for large landscapes that are mostly empty, whose cost per step scales with the vegetated area
+    # and its perimeter instead of the size of the map (a map with vegetation on more than a tenth of it is stepped
+    # as a whole, like in ShrubEngine)
+    #
+    # only the active cells, the vegetated cells and the cells next to them, are updated one by one with the
+    # transition tables of ShrubEngine. Every other cell is empty and has no vegetated neighbour, so all it can do
+    # is turn into grass with probability weg = theta * pg: the number of such cells that do is drawn from a
+    # binomial distribution and placed on random background cells. The vegetated cells of every map are kept as
+    # an index from step to step, so no step passes over the whole map, and the removal strategies get the shrubs
+    # from the active cells
+    #
+    # the transitions have the same probabilities as in ShrubEngine, but the random numbers are used differently,
+    # so runs give other (statistically equivalent) results than ShrubEngine for the same seed. Only the state maps
+    # are allocated, none of the per-step buffers of ShrubEngine
+    def allocate(self, shape):
+        return {'state': np.empty(shape, dtype=np.uint8)}
+
+    def compact(self, keep):
+        vegetated = [self.vegetated[position] for position in np.flatnonzero(keep)]
+        super().compact(keep)
+        self.vegetated = vegetated
+
+    def countStates(self):
+        #lists the vegetated cells of every map once, the counts are kept up to date from them by step()
+        self.vegetated = [np.flatnonzero(state) for state in self.state]
+        self.counts = np.array([self.vegetationCount(position) for position in range(len(self.state))],
+                               dtype=np.int64).reshape(-1, 3)
+
+    def vegetationCount(self, position):
+        state = self.state[position].reshape(-1)[self.vegetated[position]]
+        grass = np.count_nonzero(state == GRASS)
+        shrub = len(state) - grass
+        return self.cellsPerMap() - grass - shrub, grass, shrub
+
+    def step(self):
+        profiler = self.profiler
+        profiler.start()
+        shape = self.state.shape[1:]
+        pg = self.counts[:, GRASS] / self.cellsPerMap()
+        first, second = transitionTables(self, GrassFraction(pg))
+        outcome = np.tile(outcomeTable, len(pg))
+        self.year = self.year + 1
+        remove = strategies[self.removal]
+        profiler.lap('neighbourhood')
+        for position, stream in enumerate(self.streams):
+            state = self.state[position].reshape(-1)
+            whole = len(self.vegetated[position]) * 10 > state.size
+            if whole:
+                #with vegetation all over the map nearly every cell is active, so the whole map is stepped at once
+                active = slice(None)
+                code = window4total(neighbourWeight[self.state[position]], np.empty(shape, dtype=np.uint8)).reshape(-1)
+                old = state.copy()
+            else:
+                active = activeCells(self.vegetated[position], shape)
+                code = neighbourCode(state, active, shape)
+                old = state[active]
+            profiler.lap('neighbourhood')
+
+            #same table lookups as ShrubEngine.step(), for the active cells only
+            random = generator(stream, self.timestep, TRANSITION).random(len(old), dtype=np.float32)
+            profiler.lap('random')
+            key = old.astype(np.intp) * 25 + code + position * KEYS
+            key = 2 * key + (random < first[key])
+            profiler.lap('grass')
+            key = 2 * key + (random < second[key])
+
+            #grass growth on the background, weg of an empty cell without grass neighbours
+            background = self.counts[position, EMPTY] - np.count_nonzero(old == EMPTY)
+            events = generator(stream, self.timestep, BACKGROUND)
+            growth = events.binomial(background, float(first[position * KEYS + EMPTY * 25]))
+            grown = placeBackground(state, active, growth, background, shape, events)
+            profiler.lap('grass')
+
+            state[active] = outcome[key]
+            state[grown] = GRASS
+            profiler.lap('shrub')
+            if profiler.countTransitions:
+                transitions = transitionCounts(key, len(pg))
+                transitions['empty2grass'] += len(grown)
+                profiler.count(transitions)
+                profiler.lap('counting')
+            #mechanical removal event every nth year, only on cells that were shrubs at the start of the step
+            if self.year[position] == self.n[position]:
+                #the active cells are sorted, so are their shrubs
+                shrubs = ShrubCells(np.flatnonzero(old == SHRUB) if whole else active[old == SHRUB], shape)
+                cells = remove(shrubs, self.f[position], stream, self.timestep)
+                if profiler.countTransitions:
+                    profiler.count({'removed': np.count_nonzero(state[cells])})
+                state[cells] = EMPTY
+                self.year[position] = 0
+                profiler.lap('removal')
+            if whole:
+                self.vegetated[position] = np.flatnonzero(state)
+            else:
+                cells = np.concatenate([active, grown])
+                self.vegetated[position] = cells[state[cells] != EMPTY]
+            self.counts[position] = self.vegetationCount(position)
+            profiler.lap('density')
+        self.timestep = self.timestep + 1
+        profiler.endStep(self)
@@ -0,0 +1,331 @@
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from biotopStore import BiotopStore, ChunkCollector
+from instrumentation import Profiler
+from mapReport import BufferedMapWriter
+from resultCache import ResultCache, parameterKey
+from shrubEngine import runBatch, runShared
+
+# initial state of the worker process, sent once by the pool initializer instead of with every row
+workerState = None
+
+
+def grazingKey(parameters):
+    #spawn key of the grazing pressure h of a parameter cell, the bits of its rounded value (see parameterKey())
+    key = np.array(parameterKey(parameters)[:1], dtype=np.float64).view(np.uint64)
+    return tuple(int(value) for value in key)
+
+
+def cellSeed(seed, parameters):
+    #every parameter cell gets a reproducible stream, derived from the sweep seed and its grazing pressure h only,
+    #so results do not depend on the number of workers, the order in which cells are run or the layout of the
+    #sweep, and a cell shared by two sweeps has the same result in both (see resultCache.py)
+    #cells that only differ in n and f use common random numbers, which keeps their differences down to the
+    #management and lets runShared() simulate the steps before their first removal event once
+    return np.random.SeedSequence(seed, spawn_key=grazingKey(parameters))
+
+
+def fitSlopes(densities, start=0, stop=None):
+    #least squares fit of log(density) against log(timestep) for all runs at once, densities is a
+    #(..., timesteps) array with the density at timestep i + 1 in densities[..., i] like in a shrubDensity list
+    #start and stop select the timesteps of the fit like a slice, e.g. start=10 leaves out a transient of 10
+    #timesteps, so fits over other windows need no new runs. Returns a dict of arrays in the layout of densities
+    #without the timestep axis: slope, intercept, r2 and extinct. If the density becomes 0.0 within the window,
+    #the run counts as extinct and gets slope -1 (and nan intercept and r2) to avoid log(0)
+    densities = np.asarray(densities, dtype=np.float64)
+    window = densities[..., start:stop]
+    if window.shape[-1] < 2:
+        raise ValueError("a slope needs at least 2 timesteps, the window has %d" % window.shape[-1])
+    x = np.log(np.arange(1, densities.shape[-1] + 1, dtype=np.float64))[start:stop]
+    extinct = ~np.all(window > 0, axis=-1)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        y = np.log(np.where(extinct[..., None], 1.0, window))
+        xMean = x.mean()
+        x = x - xMean
+        yMean = y.mean(axis=-1)
+        y = y - yMean[..., None]
+        slope = y @ x / (x @ x)
+        intercept = yMean - slope * xMean
+        residual = y - slope[..., None] * x
+        #a constant density is fitted exactly, but has no variance to explain
+        r2 = 1 - np.sum(residual * residual, axis=-1) / np.sum(y * y, axis=-1)
+    return {'slope': np.where(extinct, -1.0, slope),
+            'intercept': np.where(extinct, np.nan, intercept),
+            'r2': np.where(extinct, np.nan, r2),
+            'extinct': extinct}
+
+
+def shrubSlope(shrubDensity):
+    #slope of a single shrubDensity list, -1 if it becomes 0.0 at some point (see fitSlopes())
+    return fitSlopes([item[0] for item in shrubDensity])['slope'].item()
+
+
+def rowProfiler(trace, idx):
+    #profiler appending the runs of row idx to the JSON-lines file rowIDX.jsonl in the trace directory, None without
+    #a trace directory
+    if trace is None:
+        return None
+    os.makedirs(trace, exist_ok=True)
+    return Profiler(trace=os.path.join(trace, "row%03d.jsonl" % idx))
+
+
+def initWorker(initialState):
+    global workerState
+    workerState = initialState
+
+
+def runRow(task):
+    #row holds the parameters of the cells in columns of row idx of the sweep, all cells of the row if columns is None
+    idx, row, nrOfTimeSteps, seed, tolerance, window, removal, trace, reportPolicy, columns = task
+    if columns is None:
+        columns = range(len(row))
+    seeds = [cellSeed(seed, parameters) for parameters in row]
+    densities = np.empty((len(row), nrOfTimeSteps))
+    chunks = []
+    profiler = rowProfiler(trace, idx)
+    if reportPolicy is None or reportPolicy.mode == 'off':
+        runShared(workerState, row, nrOfTimeSteps, seeds, tolerance=tolerance, window=window, out=densities,
+                  removal=removal, profiler=profiler)
+    else:
+        #maps for a BiotopStore are sent back encoded, the store file itself is only written by runSweep
+        cells = [(idx, idy) for idy in columns]
+        reporter = ChunkCollector(reportPolicy) if reportPolicy.store else BufferedMapWriter(reportPolicy)
+        with reporter:
+            runBatch(workerState, row, nrOfTimeSteps, seeds, tolerance=tolerance, window=window, reporter=reporter,
+                     cells=cells, out=densities, removal=removal, profiler=profiler)
+        if reportPolicy.store:
+            chunks = reporter.chunks
+    return densities, chunks
+
+
+def imapRows(function, tasks, initialState, workers=None):
+    #runs function on every task on a pool of worker processes (all cores by default, workers=1 runs in this
+    #process) and yields the results in the order of tasks
+    if workers is None:
+        workers = os.cpu_count() or 1
+    if workers == 1:
+        initWorker(initialState)
+        for task in tasks:
+            yield function(task)
+        return
+    #fork keeps the sweep scripts from being re-run in every worker where it is available
+    context = multiprocessing.get_context('fork') if 'fork' in multiprocessing.get_all_start_methods() else None
+    with ProcessPoolExecutor(max_workers=workers, mp_context=context,
+                             initializer=initWorker, initargs=(initialState,)) as executor:
+        yield from executor.map(function, tasks)
+
+
+def mapRows(function, tasks, initialState, workers=None):
+    return list(imapRows(function, tasks, initialState, workers))
+
+
+def runCells(parameterArray, cells, initialState, nrOfTimeSteps, resultArray, workers=None, seed=0, tolerance=None,
+             window=5, reportPolicy=None, store=None, cache=None, densityArray=None, removal='bernoulli', trace=None):
+    #runs the (idx, idy) cells of parameterArray, one task per row, and writes their slopes into resultArray and
+    #their density series into densityArray if it is given. Cells whose slope is in the ResultCache cache are not
+    #run again (unless biotop maps are reported or the densities are needed), the slopes of every finished row are
+    #added to it right away. With a trace directory, every row is profiled into its own trace file (see rowProfiler())
+    lookup = cache is not None and densityArray is None and (reportPolicy is None or reportPolicy.mode == 'off')
+    columnsOfRow = {}
+    for idx, idy in sorted(cells):
+        slope = cache.get(parameterArray[idx, idy]) if lookup else None
+        if slope is None:
+            columnsOfRow.setdefault(idx, []).append(idy)
+        else:
+            resultArray[idx, idy] = slope
+    tasks = [(idx, parameterArray[idx, idys], nrOfTimeSteps, seed, tolerance, window, removal, trace, reportPolicy,
+              idys) for idx, idys in sorted(columnsOfRow.items())]
+    for task, (densities, chunks) in zip(tasks, imapRows(runRow, tasks, initialState, workers)):
+        idx, row, columns = task[0], task[1], task[-1]
+        rowSlopes = fitSlopes(densities)['slope']
+        resultArray[idx, columns] = rowSlopes
+        if densityArray is not None:
+            densityArray[idx, columns] = densities
+        if cache is not None:
+            cache.put(row, rowSlopes)
+        for (idx, idy), timestep, chunk in chunks:
+            store.writeChunk(idx * parameterArray.shape[1] + idy, timestep, chunk)
+
+
+def openCache(cache, initialState, nrOfTimeSteps, seed, tolerance, window, removal):
+    return None if cache is None else ResultCache(cache, nrOfTimeSteps, initialState, seed, tolerance, window, removal)
+
+
+def runSweep(parameterArray, initialState, nrOfTimeSteps, workers=None, seed=0, tolerance=None, window=5,
+             reportPolicy=None, cache=None, densityArray=None, removal='bernoulli', trace=None):
+    #runs every (h, n, f) cell of the (rows, columns, 3) parameterArray, one row per task, and returns resultArray
+    #with the slopes and visualizationArray with 0 (controlled) and 1 (not controlled) in the layout of parameterArray
+    #runs with extinct shrubs always stop early, tolerance and window also stop runs at a steady shrub density
+    #biotop maps are only written if a mapReport.ReportPolicy asks for them, a policy with a store path collects
+    #them in one BiotopStore with scenario number idx * columns + idy
+    #cache is the path of a SQLite result cache (see resultCache.py), cells already in it are not run again
+    #densityArray, a (rows, columns, timesteps) array, gets the shrub density series of every cell for other fits
+    #with fitSlopes(), e.g. fitSlopes(densityArray, start=10) for the slopes after a transient of 10 timesteps
+    #removal is the mechanical removal strategy of all cells, one of removal.strategies (e.g. 'exact' or 'edges')
+    #trace is a directory that gets a JSON-lines trace (see instrumentation.Profiler) of the runs of every row
+    parameterArray = np.asarray(parameterArray, dtype=np.float64)
+    initialState = np.asarray(initialState, dtype=np.uint8)
+    rows, columns = parameterArray.shape[:2]
+    # this will store the resulting slope
+    resultArray = np.full((rows, columns), np.nan)
+    store = None
+    if reportPolicy is not None and reportPolicy.mode != 'off' and reportPolicy.store:
+        shape = (rows * columns, nrOfTimeSteps) + initialState.shape
+        store = BiotopStore(reportPolicy.store, 'w', shape, parameterArray.reshape(-1, 3))
+    cache = openCache(cache, initialState, nrOfTimeSteps, seed, tolerance, window, removal)
+    try:
+        runCells(parameterArray, np.ndindex(rows, columns), initialState, nrOfTimeSteps, resultArray, workers, seed,
+                 tolerance, window, reportPolicy, store, cache, densityArray, removal, trace)
+    finally:
+        if store is not None:
+            store.close()
+        if cache is not None:
+            cache.close()
+
+    # storing 2d array with 0 (negative) and 1 (positive values) for visualization, derived from resultArray
+    visualizationArray = np.where(resultArray > 0, 1.0, 0.0)
+    return resultArray, visualizationArray
+
+
+def splitBlock(block):
+    #quarters a block (r0, r1, c0, c1) given by its inclusive corner indices, a side of length 1 is not split
+    r0, r1, c0, c1 = block
+    rowHalves = [(r0, (r0 + r1) // 2), ((r0 + r1) // 2, r1)] if r1 - r0 > 1 else [(r0, r1)]
+    colHalves = [(c0, (c0 + c1) // 2), ((c0 + c1) // 2, c1)] if c1 - c0 > 1 else [(c0, c1)]
+    return [(rows + cols) for rows in rowHalves for cols in colHalves]
+
+
+def blockEdges(size, spacing):
+    edges = sorted(set(range(0, size, spacing)) | {size - 1})
+    return edges if len(edges) > 1 else edges * 2
+
+
+def runAdaptiveSweep(parameterArray, initialState, nrOfTimeSteps, spacing=8, workers=None, seed=0, tolerance=None,
+                     window=5, cache=None, removal='bernoulli', trace=None):
+    #adaptive version of runSweep for finding the boundary between controlled and not controlled cells:
+    #the cells on a coarse grid (every spacing-th row and column) are run first, every block of the grid whose
+    #corners disagree is split into quarters whose new corners are run next, until the disagreeing blocks are
+    #down to neighbouring cells. Blocks whose corners agree are filled with their corner value, so the boundary
+    #has the resolution of the full grid, only features smaller than spacing that touch no corner can be missed
+    #returns resultArray (slopes, nan for cells that were not run) and visualizationArray like runSweep
+    #run cells get the same seeds as in runSweep, so their slopes are the same as in the full sweep, and like
+    #there cache is the path of a SQLite result cache whose cells are not run again, removal is the removal strategy
+    #and trace a directory for the traces of the rows like in runSweep
+    parameterArray = np.asarray(parameterArray, dtype=np.float64)
+    initialState = np.asarray(initialState, dtype=np.uint8)
+    rows, columns = parameterArray.shape[:2]
+    resultArray = np.full((rows, columns), np.nan)
+    filled = np.zeros((rows, columns))
+    cache = openCache(cache, initialState, nrOfTimeSteps, seed, tolerance, window, removal)
+
+    rowEdges = blockEdges(rows, spacing)
+    colEdges = blockEdges(columns, spacing)
+    blocks = [(r0, r1, c0, c1) for r0, r1 in zip(rowEdges, rowEdges[1:]) for c0, c1 in zip(colEdges, colEdges[1:])]
+    try:
+        while blocks:
+            corners = [[(r, c) for r in block[:2] for c in block[2:]] for block in blocks]
+            cells = set(cell for blockCorners in corners for cell in blockCorners if np.isnan(resultArray[cell]))
+            runCells(parameterArray, cells, initialState, nrOfTimeSteps, resultArray, workers, seed, tolerance,
+                     window, cache=cache, removal=removal, trace=trace)
+            refined = []
+            for (r0, r1, c0, c1), blockCorners in zip(blocks, corners):
+                controlled = set(resultArray[cell] > 0 for cell in blockCorners)
+                if len(controlled) == 1:
+                    filled[r0:r1 + 1, c0:c1 + 1] = controlled.pop()
+                elif r1 - r0 > 1 or c1 - c0 > 1:
+                    refined.extend(splitBlock((r0, r1, c0, c1)))
+            blocks = refined
+    finally:
+        if cache is not None:
+            cache.close()
+
+    visualizationArray = np.where(np.isnan(resultArray), filled, np.where(resultArray > 0, 1.0, 0.0))
+    return resultArray, visualizationArray
+
+
+class RunningStats:
+    # Welford's streaming mean and variance, realizations are added one at a time so none of them has to be kept
+    def __init__(self, shape=()):
+        self.count = 0
+        self.mean = np.zeros(shape)
+        self.m2 = np.zeros(shape)
+
+    def add(self, values):
+        self.count = self.count + 1
+        delta = values - self.mean
+        self.mean += delta / self.count
+        self.m2 += delta * (values - self.mean)
+
+    def variance(self):
+        if self.count < 2:
+            return np.full_like(self.mean, np.nan)
+        return self.m2 / (self.count - 1)
+
+    def confidenceInterval(self, z=1.96):
+        #normal approximation of the confidence interval of the mean, 1.96 gives 95 %
+        halfWidth = z * np.sqrt(self.variance() / self.count)
+        return self.mean - halfWidth, self.mean + halfWidth
+
+
+def replicateSeed(seed, parameters, replicate):
+    #like cellSeed(), replicate r of every cell with the same grazing pressure h gets the same stream, so cells that
+    #only differ in management are compared with common random numbers replicate by replicate
+    return np.random.SeedSequence(seed, spawn_key=grazingKey(parameters) + (replicate,))
+
+
+def runReplicateRow(task):
+    idx, row, nrOfTimeSteps, nrOfReplicates, seed, batchSize, removal, trace = task
+    densityStats = [RunningStats(nrOfTimeSteps) for cell in row]
+    slopeStats = [RunningStats() for cell in row]
+    extinct = np.zeros(len(row), dtype=np.int64)
+    profiler = rowProfiler(trace, idx)
+    #replicates of all cells of the row are run batchSize at a time and folded into the running statistics right
+    #away, runShared() simulates the steps every replicate has in common across cells before their first removal
+    for start in range(0, nrOfReplicates, batchSize):
+        replicates = range(start, min(start + batchSize, nrOfReplicates))
+        batch = np.repeat(row, len(replicates), axis=0)
+        seeds = [replicateSeed(seed, cell, replicate) for cell in row for replicate in replicates]
+        densities = np.empty((len(batch), nrOfTimeSteps))
+        runShared(workerState, batch, nrOfTimeSteps, seeds, out=densities, removal=removal, profiler=profiler)
+        fit = fitSlopes(densities)
+        #the slope -1 of an extinct run is no fit, so only the runs that kept shrubs enter the slope statistics
+        for run, (density, slope, runExtinct) in enumerate(zip(densities, fit['slope'], fit['extinct'])):
+            densityStats[run // len(replicates)].add(density)
+            if not runExtinct:
+                slopeStats[run // len(replicates)].add(slope)
+        extinct += fit['extinct'].reshape(len(row), -1).sum(axis=1)
+    rowStats = []
+    for idy in range(len(row)):
+        slopeLow, slopeHigh = slopeStats[idy].confidenceInterval()
+        slope = slopeStats[idy].mean if slopeStats[idy].count else np.nan
+        rowStats.append((densityStats[idy].mean, densityStats[idy].variance(), slope, slopeLow, slopeHigh,
+                         extinct[idy] / nrOfReplicates))
+    return rowStats
+
+
+def runReplicates(parameterArray, initialState, nrOfTimeSteps, nrOfReplicates, workers=None, seed=0, batchSize=25,
+                  removal='bernoulli', trace=None):
+    #Monte Carlo mode of runSweep: every cell is run nrOfReplicates times, the shrub density of every timestep and
+    #the log-log slope are accumulated as running mean and variance, the slope only over the replicates that did
+    #not go extinct (nan if all did), since the -1 runSweep gives extinct runs is no fitted slope. The replicates of a cell have independent seeds, but replicate r of all cells with the same h
+    #shares its seed (see replicateSeed()), so differences between management cells have far less noise than
+    #their own intervals suggest. Returns a dict of arrays in the layout of parameterArray:
+    #meanDensity and varianceDensity (with a trailing timestep axis), slope with its 95 % interval slopeLow and
+    #slopeHigh, the fraction of extinct replicates and visualizationArray: 1 (not controlled) where at most half
+    #of the replicates went extinct and the mean slope of the others is positive, 0 (controlled) otherwise.
+    #removal is the removal strategy and trace a directory for the traces of the rows like in runSweep
+    parameterArray = np.asarray(parameterArray, dtype=np.float64)
+    initialState = np.asarray(initialState, dtype=np.uint8)
+    tasks = [(idx, row, nrOfTimeSteps, nrOfReplicates, seed, batchSize, removal, trace)
+             for idx, row in enumerate(parameterArray)]
+    rows = mapRows(runReplicateRow, tasks, initialState, workers)
+
+    names = ['meanDensity', 'varianceDensity', 'slope', 'slopeLow', 'slopeHigh', 'extinct']
+    result = {name: np.array([[cellStats[i] for cellStats in row] for row in rows], dtype=np.float64)
+              for i, name in enumerate(names)}
+    result['visualizationArray'] = np.where((result['extinct'] <= 0.5) & (result['slope'] > 0), 1.0, 0.0)
+    return result
@@ -0,0 +1,219 @@
+import numpy as np
+import pytest
+
+from initialState import loadInitialState, readMap
+from instrumentation import Profiler
+from mapReport import MV_UINT1, writeMap
+from packedEngine import PackedShrubEngine
+from patches import ShrubPatches, cellPatches
+from randomStreams import REMOVAL, TRANSITION, streamKey, uniform
+from shrubEngine import EMPTY, GRASS, SHRUB, ShrubEngine, defaultParameters, runBatch, runShared
+from sparseEngine import SparseShrubEngine
+from threadedEngine import ThreadedShrubEngine
+from tiledEngine import TiledShrubEngine
+
+# checks of the engines against a plain NumPy port of ShrubManage.dynamic() and against each other, run with
+# python -m pytest -q
+
+# (h, n, f) of the runs compared, with and without grazing and removal
+parameters = [(1.0, 5, 0.3), (0.2, 2, 0.9), (0.5, 1, 0.1), (0.0, 0, 0.0), (0.7, 3, 0.5)]
+
+
+@pytest.fixture(scope='module')
+def initialState():
+    return readMap('initialStateA.map')
+
+
+def window4(values):
+    #pcraster window4total of a map, cells outside the map count as 0
+    values = values.astype(np.float32)
+    total = np.zeros_like(values)
+    total[1:] += values[:-1]
+    total[:-1] += values[1:]
+    total[:, 1:] += values[:, :-1]
+    total[:, :-1] += values[:, 1:]
+    return total
+
+
+def referenceRun(biotop, h, n, f, nrOfTimeSteps, seed):
+    #ShrubManage.dynamic() with pcraster operations replaced by NumPy ones, drawing its uniform(1) fields from the
+    #streams of the engine: the TRANSITION field for all transitions and the REMOVAL field for mechanical removal
+    model = defaultParameters
+    key = streamKey(seed)
+    biotop = biotop.astype(np.uint8)
+    year = 0
+    shrubDensity = []
+    for timestep in range(1, nrOfTimeSteps + 1):
+        shrubDensity.append([np.count_nonzero(biotop == SHRUB) / biotop.size, timestep])
+        r = uniform(key, timestep - 1, TRANSITION, np.empty(biotop.shape, dtype=np.float32))
+        grass = biotop == GRASS
+        shrub = biotop == SHRUB
+        #empty2grass and grass2empty
+        qge = window4(grass) / 4
+        pg = np.count_nonzero(grass) / biotop.size
+        weg = (model['bg'] * qge + model['theta'] * pg).astype(np.float32)
+        grassGrowth = np.where(weg > r, biotop == EMPTY, grass)
+        grassGrowth = np.where(grassGrowth, grassGrowth ^ grass, False)
+        grassDeath = np.where(model['dg'] > r, grass, False)
+        biotop = np.where(grassGrowth, GRASS, biotop)
+        biotop = np.where(grassDeath, EMPTY, biotop)
+        #empty2shrub, grass2shrub and shrub2empty
+        qs = (window4(shrub) / 4).astype(np.float32)
+        wes = ((1 - qs) * model['b1'] + model['s1']) * qs
+        wgs = ((1 - qs) * model['b2'] * (1 - h) + model['s2']) * qs
+        wse = model['ds'] + model['c'] * qs
+        shrubGrowth = np.where(wes > r, biotop == EMPTY, shrub) | np.where(wgs > r, biotop == GRASS, shrub)
+        shrubGrowth = np.where(shrubGrowth, shrubGrowth ^ shrub, False)
+        shrubDeath = np.where(wse > r, shrub, False)
+        biotop = np.where(shrubGrowth, SHRUB, biotop)
+        biotop = np.where(shrubDeath, EMPTY, biotop).astype(np.uint8)
+        #mechanical removal of the cells that were shrubs at the start of the step
+        year = year + 1
+        if year == n:
+            removed = uniform(key, timestep - 1, REMOVAL, np.empty(biotop.shape, dtype=np.float32)) < np.float32(f)
+            biotop = np.where(removed & shrub, EMPTY, biotop).astype(np.uint8)
+            year = 0
+    return shrubDensity, biotop
+
+
+@pytest.mark.parametrize('h, n, f', parameters)
+def test_referenceDynamic(initialState, h, n, f):
+    shrubDensity, biotop = referenceRun(initialState, h, n, f, 30, 7)
+    engine = ShrubEngine(initialState, h, n, f, 7)
+    assert engine.run(30) == shrubDensity
+    assert np.array_equal(engine.biotop, biotop)
+
+
+def batchStates(engineClass, initialState, nrOfTimeSteps, **options):
+    #states of a batch of all parameters after every step
+    h, n, f = np.transpose(parameters)
+    stack = np.broadcast_to(initialState, (len(parameters),) + initialState.shape)
+    engine = engineClass(stack, h, n, f, list(range(len(parameters))), **options)
+    states = []
+    for timestep in range(nrOfTimeSteps):
+        engine.step()
+        states.append((engine.biotop.copy(), engine.counts.copy()))
+    if hasattr(engine, 'close'):
+        engine.close()
+    return states
+
+
+@pytest.mark.parametrize('engineClass, options', [
+    (PackedShrubEngine, {}),
+    (SparseShrubEngine, {}),
+    (ThreadedShrubEngine, {'threads': 1}),
+    (ThreadedShrubEngine, {'threads': 3}),
+    (ThreadedShrubEngine, {'threads': 2, 'bandRows': 7}),
+])
+def test_batchEngines(initialState, engineClass, options):
+    expected = batchStates(ShrubEngine, initialState, 20)
+    states = batchStates(engineClass, initialState, 20, **options)
+    for (biotop, counts), (expectedBiotop, expectedCounts) in zip(states, expected):
+        assert np.array_equal(biotop, expectedBiotop)
+        assert np.array_equal(counts, expectedCounts)
+
+
+def test_profiledCounts(initialState):
+    #with transition counting the state counts come from the outcome keys instead of a recount
+    expected = batchStates(ShrubEngine, initialState, 20)
+    states = batchStates(ShrubEngine, initialState, 20, profiler=Profiler())
+    for (biotop, counts), (expectedBiotop, expectedCounts) in zip(states, expected):
+        assert np.array_equal(biotop, expectedBiotop)
+        assert np.array_equal(counts, expectedCounts)
+
+
+def test_missingValues(initialState, tmp_path):
+    biotop = initialState.copy()
+    biotop[0] = MV_UINT1
+    path = str(tmp_path / 'missing.map')
+    writeMap(path, biotop)
+    with pytest.raises(ValueError):
+        loadInitialState(path, str(tmp_path))
+    with pytest.raises(ValueError):
+        ShrubEngine(biotop)
+
+
+@pytest.mark.parametrize('tile, workers', [(64, 1), ((50, 33), 1), (1024, 1), (64, 2)])
+def test_tiledEngine(initialState, tmp_path, tile, workers):
+    for h, n, f in parameters:
+        expected = ShrubEngine(initialState, h, n, f, 3)
+        engine = TiledShrubEngine(initialState, h, n, f, 3, directory=str(tmp_path), tile=tile, workers=workers)
+        try:
+            assert engine.run(15) == expected.run(15)
+            assert np.array_equal(engine.biotop, expected.biotop)
+        finally:
+            engine.close()
+
+
+def test_runShared(initialState):
+    #runs with the same grazing pressure and seed share their steps up to the first removal event
+    grid = np.array([(h, n, f) for h in (0.0, 0.6) for n in (0, 1, 3, 4) for f in (0.2, 0.8)])
+    seeds = [11] * len(grid)
+    batchReasons, sharedReasons = [], []
+    batchOut, sharedOut = np.empty((len(grid), 25)), np.empty((len(grid), 25))
+    expected = runBatch(initialState, grid, 25, seeds, batchSize=5, reasons=batchReasons, out=batchOut)
+    shrubDensities = runShared(initialState, grid, 25, seeds, reasons=sharedReasons, out=sharedOut)
+    assert shrubDensities == expected
+    assert sharedReasons == batchReasons
+    assert np.array_equal(sharedOut, batchOut)
+
+
+def test_checkpointResume(initialState, tmp_path):
+    path = str(tmp_path / 'checkpoint.npz')
+    h, n, f = np.transpose(parameters)
+    stack = np.broadcast_to(initialState, (len(parameters),) + initialState.shape)
+    expected = ShrubEngine(stack, h, n, f, 5)
+    expectedDensities = expected.run(30)
+    interrupted = ShrubEngine(stack, h, n, f, 5)
+    interrupted.run(13)
+    interrupted.saveCheckpoint(path)
+    engine = ShrubEngine.restore(path)
+    assert engine.run(30) == expectedDensities
+    assert np.array_equal(engine.biotop, expected.biotop)
+    assert engine.terminationReason == expected.terminationReason
+
+
+def floodFill(shrub):
+    #patch number of every shrub cell (4-neighbourhood) by a flood fill from every unlabelled shrub, -1 for cells
+    #that are no shrub
+    rows, cols = shrub.shape
+    labels = np.full(shrub.shape, -1)
+    patch = 0
+    for y, x in zip(*np.nonzero(shrub)):
+        if labels[y, x] >= 0:
+            continue
+        labels[y, x] = patch
+        queue = [(y, x)]
+        while queue:
+            cy, cx = queue.pop()
+            for ny, nx in ((cy - 1, cx), (cy + 1, cx), (cy, cx - 1), (cy, cx + 1)):
+                if 0 <= ny < rows and 0 <= nx < cols and shrub[ny, nx] and labels[ny, nx] < 0:
+                    labels[ny, nx] = patch
+                    queue.append((ny, nx))
+        patch = patch + 1
+    return labels
+
+
+def samePatches(labels, expected):
+    #both labellings put the same cells into the same patches
+    if not np.array_equal(labels < 0, expected < 0):
+        return False
+    pairs = np.unique(np.stack([labels[expected >= 0], expected[expected >= 0]]), axis=1)
+    return len(np.unique(pairs[0])) == len(np.unique(pairs[1])) == pairs.shape[1]
+
+
+def test_shrubPatches():
+    engine = ShrubEngine(np.random.default_rng(2).integers(0, 3, (60, 45)).astype(np.uint8), 0.3, 4, 0.5, 9,
+                         removal='smallestPatches')
+    patches = ShrubPatches(engine.biotop)
+    for timestep in range(25):
+        expected = floodFill(engine.biotop == SHRUB)
+        assert samePatches(patches.labels(), expected)
+        assert samePatches(ShrubPatches(engine.biotop).labels(), expected)
+        cells = np.flatnonzero(engine.biotop == SHRUB)
+        labels = np.full(engine.biotop.size, -1)
+        labels[cells] = cellPatches(cells, engine.biotop.shape[1])
+        assert samePatches(labels.reshape(engine.biotop.shape), expected)
+        assert patches.count() == expected.max() + 1
+        engine.step()
+        patches.update(engine.biotop)
@@ -0,0 +1,141 @@
+import os
+from concurrent.futures import ThreadPoolExecutor
+from itertools import repeat
+
+import numpy as np
+
+from randomStreams import TRANSITION, uniformAt
+from removal import ShrubCells, strategies
+from shrubEngine import (EMPTY, GRASS, KEYS, SHRUB, GrassFraction, ShrubEngine, neighbourWeight, outcomeTable,
+                         transitionCounts, transitionTables)
+
+
+def bandBounds(rows, bandRows):
+    return [(y0, min(y0 + bandRows, rows)) for y0 in range(0, rows, bandRows)]
+
+
+class ThreadedShrubEngine(ShrubEngine):
+    # ShrubEngine whose steps run on a pool of threads: every map is split into bands of rows and every band is
+    # stepped by one thread in the buffers of ShrubEngine, with NumPy kernels that release the GIL. A step has two
+    # phases, first every band puts the neighbour weights of its cells into the weight buffer, then every band sums
+    # the weights around its cells (reading the rows next to it) and does the transitions of its cells. The state
+    # and grass counts of the bands are summed once per step for the grass fraction pg and the shrub density
+    #
+    # every band draws the part of the random field of the whole map that covers its rows (see
+    # randomStreams.uniformAt()), so results are the same as ShrubEngine's, whatever the number of threads and the
+    # size of the bands. close() ends the pool
+    def __init__(self, biotop, h=0.0, n=0, f=0.0, seed=None, removal='bernoulli', threads=None, bandRows=None,
+                 **parameters):
+        self.threads = threads or os.cpu_count() or 1
+        self.bandRows = bandRows
+        self.executor = None
+        super().__init__(biotop, h, n, f, seed, removal, **parameters)
+
+    def bands(self):
+        #(position, y0, y1) of every band of every running scenario
+        rows = self.mapShape[0]
+        bandRows = self.bandRows or -(-rows // self.threads)
+        return [(position, y0, y1) for position in range(len(self.scenario)) for y0, y1 in bandBounds(rows, bandRows)]
+
+    def weighBand(self, band):
+        position, y0, y1 = band
+        np.take(neighbourWeight, self.state[position, y0:y1], out=self.weight[position, y0:y1], mode='clip')
+
+    def stepBand(self, band, first, second, outcome, removing):
+        #transitions of the cells of a band, returns the number of its grass and shrub cells afterwards, the
+        #transition counts of the band if the profiler wants them and, if its scenario has a removal event (removing
+        #holds a flag per scenario), the flat indices of its cells that were shrubs at the start of the step
+        position, y0, y1 = band
+        rows, cols = self.mapShape
+        weight = self.weight[position]
+        code = self.code[position, y0:y1]
+        #von Neumann sum like window4total(), the rows above and below the band come from the bands next to it
+        np.copyto(code, 0)
+        above = max(y0 - 1, 0)
+        np.add(code[above - y0 + 1:], weight[above:y1 - 1], out=code[above - y0 + 1:])
+        below = min(y1 + 1, rows)
+        np.add(code[:below - y0 - 1], weight[y0 + 1:below], out=code[:below - y0 - 1])
+        np.add(code[:, 1:], weight[y0:y1, :-1], out=code[:, 1:])
+        np.add(code[:, :-1], weight[y0:y1, 1:], out=code[:, :-1])
+
+        #same table lookups as ShrubEngine.step()
+        biotop = self.state[position, y0:y1]
+        random = self.random[position, y0:y1]
+        threshold = self.threshold[position, y0:y1]
+        key = self.key[position, y0:y1]
+        change = self.change[position, y0:y1]
+        uniformAt(self.streams[position], self.timestep, TRANSITION, y0 * cols, random.reshape(-1))
+        np.multiply(biotop, 25, out=key)
+        np.add(key, code, out=key)
+        np.add(key, position * KEYS, out=key)
+        np.take(first, key, out=threshold, mode='clip')
+        np.less(random, threshold, out=change)
+        np.multiply(key, 2, out=key)
+        np.add(key, change, out=key)
+        np.take(second, key, out=threshold, mode='clip')
+        np.less(random, threshold, out=change)
+        np.multiply(key, 2, out=key)
+        np.add(key, change, out=key)
+        shrubs = None
+        if removing[position]:
+            shrubs = np.flatnonzero(np.equal(biotop, SHRUB, out=self.shrub[position, y0:y1])) + y0 * cols
+        np.take(outcome, key, out=biotop, mode='clip')
+        transitions = transitionCounts(key, len(self.scenario)) if self.profiler.countTransitions else None
+        return np.count_nonzero(biotop == GRASS), np.count_nonzero(biotop == SHRUB), transitions, shrubs
+
+    def step(self):
+        #the phases of the bands run on all threads at once, the profiler times them together as 'bands'
+        profiler = self.profiler
+        profiler.start()
+        if self.executor is None:
+            self.executor = ThreadPoolExecutor(self.threads)
+        bands = self.bands()
+        pg = self.counts[:, GRASS] / self.cellsPerMap()
+        first, second = transitionTables(self, GrassFraction(pg))
+        outcome = np.tile(outcomeTable, len(pg))
+        list(self.executor.map(self.weighBand, bands))
+        profiler.lap('neighbourhood')
+        #mechanical removal event every nth year, the bands list the shrubs of the scenarios with an event
+        self.year = self.year + 1
+        removing = self.year == self.n
+        counts = np.zeros((len(pg), 3), dtype=np.int64)
+        shrubs = [[] for position in range(len(pg))]
+        bandCounts = self.executor.map(self.stepBand, bands, repeat(first), repeat(second), repeat(outcome),
+                                       repeat(removing))
+        for (position, y0, y1), (grass, shrub, transitions, bandShrubs) in zip(bands, bandCounts):
+            counts[position, GRASS] += grass
+            counts[position, SHRUB] += shrub
+            if transitions is not None:
+                profiler.count(transitions)
+            if bandShrubs is not None:
+                shrubs[position].append(bandShrubs)
+        profiler.lap('bands')
+
+        #the removal itself once all bands are done, the bands are in row order so their shrubs are sorted
+        remove = strategies[self.removal]
+        for scenario in np.flatnonzero(removing):
+            scenarioShrubs = ShrubCells(np.concatenate(shrubs[scenario]), self.mapShape)
+            cells = remove(scenarioShrubs, self.f[scenario], self.streams[scenario], self.timestep)
+            biotop = self.state[scenario].reshape(-1)
+            removed = np.count_nonzero(biotop[cells] == SHRUB)
+            counts[scenario, SHRUB] -= removed
+            if profiler.countTransitions:
+                profiler.count({'removed': removed})
+            biotop[cells] = EMPTY
+            self.year[scenario] = 0
+        profiler.lap('removal')
+        counts[:, EMPTY] = self.cellsPerMap() - counts[:, GRASS] - counts[:, SHRUB]
+        self.counts = counts
+        self.timestep = self.timestep + 1
+        profiler.endStep(self)
+
+    def close(self):
+        if self.executor is not None:
+            self.executor.shutdown()
+            self.executor = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
@@ -0,0 +1,157 @@
+import multiprocessing
+import os
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from randomStreams import REMOVAL, TRANSITION, uniformAt
+from shrubEngine import (EMPTY, GRASS, SHRUB, GrassFraction, ShrubEngine, neighbourWeight, outcomeTable,
+                         transitionCounts, transitionTables, window4total)
+
+# state maps opened by this process, keyed by path, so a worker maps every file once
+openMaps = {}
+
+
+def openMap(path):
+    if path not in openMaps:
+        openMaps[path] = np.load(path, mmap_mode='r+')
+    return openMaps[path]
+
+
+def tileBounds(shape, tile):
+    #(y0, y1, x0, x1) of every tile of a map of shape, tiles at the right and lower edge may be smaller
+    rows, cols = shape
+    tileRows, tileCols = tile
+    return [(y0, min(y0 + tileRows, rows), x0, min(x0 + tileCols, cols))
+            for y0 in range(0, rows, tileRows) for x0 in range(0, cols, tileCols)]
+
+
+def tileField(key, timestep, purpose, bounds, cols):
+    #the part of the (rows, cols) field of stream (key, timestep, purpose) that covers the tile
+    y0, y1, x0, x1 = bounds
+    out = np.empty((y1 - y0, x1 - x0), dtype=np.float32)
+    if x1 - x0 == cols:
+        return uniformAt(key, timestep, purpose, y0 * cols, out.reshape(-1)).reshape(out.shape)
+    for row in range(y0, y1):
+        uniformAt(key, timestep, purpose, row * cols + x0, out[row - y0])
+    return out
+
+
+def stepTile(task):
+    #advances one tile from the source map into the target map and returns the number of empty, grass and shrub
+    #cells of the tile afterwards, and with count its transition counts (None otherwise). The tile is read with a
+    #halo of one cell, so the neighbour codes of its edge cells see the cells of the tiles next to it
+    source, target, bounds, timestep, stream, first, second, f, count = task
+    current = openMap(source)
+    rows, cols = current.shape
+    y0, y1, x0, x1 = bounds
+    top, left = max(y0 - 1, 0), max(x0 - 1, 0)
+    window = np.asarray(current[top:min(y1 + 1, rows), left:min(x1 + 1, cols)])
+    code = window4total(neighbourWeight[window], np.empty(window.shape, dtype=np.uint8))
+    inside = (slice(y0 - top, y1 - top), slice(x0 - left, x1 - left))
+    tile = window[inside]
+
+    #same table lookups as ShrubEngine.step() with the random numbers of the tile's cells in the whole map
+    random = tileField(stream, timestep, TRANSITION, bounds, cols)
+    key = tile.astype(np.intp) * 25 + code[inside]
+    key = 2 * key + (random < first[key])
+    key = 2 * key + (random < second[key])
+    new = outcomeTable[key]
+    transitions = transitionCounts(key, 1) if count else None
+    if f is not None:
+        removal = tileField(stream, timestep, REMOVAL, bounds, cols) < np.float32(f)
+        removal &= tile == SHRUB
+        if count:
+            transitions['removed'] = np.count_nonzero(new[removal])
+        new[removal] = EMPTY
+    openMap(target)[y0:y1, x0:x1] = new
+    return np.bincount(new.reshape(-1), minlength=3), transitions
+
+
+class TiledShrubEngine(ShrubEngine):
+    # ShrubEngine for a single landscape that does not fit into memory: the state is kept in two memory mapped .npy
+    # files in directory (a temporary one by default) and every step reads the tiles of one of them, with a halo of
+    # one cell for the von Neumann neighbourhood, and writes the new tiles to the other one. Only a few tiles are in
+    # memory at a time. The grass fraction pg of the next step is summed from the counts of all tiles
+    #
+    # every cell gets the random numbers it has in the field of the whole map, so a tiled run gives the same
+    # results as ShrubEngine for the same seed, whatever the tile size and the number of workers. With workers > 1
+    # the tiles of a step are run on a pool of worker processes that map the same files, close() ends it.
+    # Only the 'bernoulli' removal works tile by tile, the other strategies need all shrubs of the map at once
+    def __init__(self, biotop, h=0.0, n=0, f=0.0, seed=None, removal='bernoulli', directory=None, tile=1024,
+                 workers=1, **parameters):
+        if np.ndim(biotop) != 2:
+            raise ValueError("a tiled engine runs a single (y, x) map, got shape %s" % (np.shape(biotop),))
+        if removal != 'bernoulli':
+            raise ValueError("a tiled engine only supports 'bernoulli' removal, got %r" % removal)
+        self.temporary = tempfile.TemporaryDirectory(prefix='shrubTiles') if directory is None else None
+        self.directory = self.temporary.name if directory is None else directory
+        self.tile = (tile, tile) if np.ndim(tile) == 0 else tuple(tile)
+        self.workers = workers
+        self.executor = None
+        super().__init__(biotop, h, n, f, seed, removal, **parameters)
+
+    def allocate(self, shape):
+        #the current map and the map the next step is written to
+        self.paths = [os.path.join(self.directory, 'state%d.npy' % number) for number in range(2)]
+        maps = [np.lib.format.open_memmap(path, 'w+', np.uint8, shape[1:]) for path in self.paths]
+        self.spare = maps[1][None]
+        return {'state': maps[0][None]}
+
+    def countStates(self):
+        #counted tile row by tile row, so the map is never read at once
+        counts = np.zeros(3, dtype=np.int64)
+        for y0 in range(0, self.biotop.shape[0], self.tile[0]):
+            counts += np.bincount(self.biotop[y0:y0 + self.tile[0]].reshape(-1), minlength=3)[:3]
+        self.counts = counts.reshape(1, 3)[:len(self.scenario)]
+
+    def step(self):
+        #the tiles may run in other processes, the profiler times them together as 'tiles'
+        profiler = self.profiler
+        profiler.start()
+        pg = self.counts[:, GRASS] / self.cellsPerMap()
+        first, second = transitionTables(self, GrassFraction(pg))
+        self.year = self.year + 1
+        f = float(self.f[0]) if self.year[0] == self.n[0] else None
+        if f is not None:
+            self.year[0] = 0
+        count = profiler.countTransitions
+        tasks = [(self.paths[0], self.paths[1], bounds, self.timestep, self.streams[0], first, second, f, count)
+                 for bounds in tileBounds(self.biotop.shape, self.tile)]
+        profiler.lap('neighbourhood')
+        if self.workers == 1:
+            results = [stepTile(task) for task in tasks]
+        else:
+            if self.executor is None:
+                fork = 'fork' in multiprocessing.get_all_start_methods()
+                context = multiprocessing.get_context('fork') if fork else None
+                self.executor = ProcessPoolExecutor(max_workers=self.workers, mp_context=context)
+            results = list(self.executor.map(stepTile, tasks))
+        counts = [tileCounts for tileCounts, transitions in results]
+        for tileCounts, transitions in results:
+            if transitions is not None:
+                profiler.count(transitions)
+        profiler.lap('tiles')
+        self.counts = np.sum(counts, axis=0).reshape(1, 3)
+        #the map just written becomes the current one
+        self.paths.reverse()
+        self.buffers['state'], self.spare = self.spare, self.buffers['state']
+        self.useScenarios(len(self.scenario))
+        self.timestep = self.timestep + 1
+        profiler.endStep(self)
+
+    def close(self):
+        if self.executor is not None:
+            self.executor.shutdown()
+            self.executor = None
+        for path in self.paths:
+            openMaps.pop(path, None)
+        if self.temporary is not None:
+            self.temporary.cleanup()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()